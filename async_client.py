@@ -0,0 +1,156 @@
+import asyncio
+import itertools
+from config import HOST, PORT, BUFSIZE, HEARTBEAT_INTERVAL
+from protocol import THTTP_Request, THTTP_Response, FrameDecoder, VERSION, VERSION_2, PREFACE, REQUEST_ID, \
+    ACCEPT_ENCODING, ZLIB, MEMBER_UPDATES, DELTA, RESUME_TOKEN
+
+
+def closed(future):
+    # a cancelled future would read as the awaiting task being cancelled. Awaiting is
+    # optional, so the exception counts as retrieved and unawaited requests stay quiet
+    future.set_exception(ConnectionError('Connection closed.'))
+    future.exception()
+
+
+class ChatClient:
+    # Qt-free asyncio client: requests are written at once without waiting for earlier
+    # responses. Each request carries a request id and returns a future of its own
+    # response, everything else the server pushes comes out of events()
+    def __init__(self, reader, writer, version=VERSION, host=HOST, compression=False, heartbeat=HEARTBEAT_INTERVAL):
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.host = host
+        # offer zlib at sign in, compress is set once the server accepts it
+        self.compression = compression and version == VERSION_2
+        self.compress = False
+        # from the last sign in, resume(token) on a new connection takes the session over
+        self.resume_token = None
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._events = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._receive())
+        # ping every heartbeat seconds so the server does not reap an idle client, None to disable
+        self._heartbeat = None
+        if heartbeat is not None:
+            self._heartbeat = asyncio.get_running_loop().create_task(self._ping_loop(heartbeat))
+
+    @classmethod
+    async def connect(cls, host=HOST, port=PORT, version=VERSION_2, compression=False, heartbeat=HEARTBEAT_INTERVAL):
+        # offer v2, an old THTTP/1.1 server closes the connection on the preface
+        reader, writer = await asyncio.open_connection(host, port)
+        if version == VERSION_2:
+            writer.write(PREFACE)
+            try:
+                reply = await reader.readexactly(len(PREFACE))
+            except asyncio.IncompleteReadError:
+                reply = b''
+            if reply != PREFACE:
+                writer.close()
+                version = VERSION
+                reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, version, host, compression, heartbeat)
+
+    def request(self, method, body='', headers=[]):
+        # the request is written now, awaiting the returned future is optional
+        request_id = str(next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            closed(future)
+            return future
+        self._pending[request_id] = future
+        request = THTTP_Request(method=method, target=self.host, headers=headers + [(REQUEST_ID, request_id)], body=body)
+        self.writer.write(request.encode(self.version, self.compress))
+        return future
+
+    def signin(self, username):
+        # member changes come as 208/209 deltas to the list of the last 204
+        headers = [(MEMBER_UPDATES, DELTA)]
+        if self.compression is True:
+            headers.append((ACCEPT_ENCODING, ZLIB))
+        return self.request('signin', username, headers)
+
+    def signout(self):
+        return self.request('signout')
+
+    def join(self, group):
+        return self.request('join', group)
+
+    def leave(self):
+        return self.request('leave')
+
+    def send(self, text):
+        return self.request('send', text)
+
+    def stats(self):
+        return self.request('stats')
+
+    def resume(self, token):
+        # 210 and the frames sent to the session since the drop, or 306 and a fresh sign in is needed
+        return self.request('resume', token)
+
+    def ping(self):
+        return self.request('ping')
+
+    async def _ping_loop(self, interval):
+        while not self.closed:
+            await asyncio.sleep(interval)
+            if not self.closed:
+                self.ping()
+
+    async def drain(self):
+        # wait until the written requests fit in the transport buffer again
+        await self.writer.drain()
+
+    async def _receive(self):
+        decoder = FrameDecoder(version=self.version)
+        try:
+            while True:
+                data = await self.reader.read(BUFSIZE)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    response = THTTP_Response(message=message, version=self.version)
+                    if response.check() is False:
+                        continue
+                    if response.get_status_code() in ('200', '210'):
+                        if response.get_header(ACCEPT_ENCODING) == ZLIB:
+                            self.compress = True
+                        self.resume_token = response.get_header(RESUME_TOKEN)
+                    future = self._pending.pop(response.get_header(REQUEST_ID), None)
+                    if future is None:
+                        self._events.put_nowait(response)
+                    elif not future.done():
+                        future.set_result(response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    closed(future)
+            self._pending.clear()
+            self._events.put_nowait(None)
+
+    async def events(self):
+        # every valid response in arrival order, ends when the connection closes
+        while True:
+            response = await self._events.get()
+            if response is None:
+                self._events.put_nowait(None)
+                return
+            yield response
+
+    def __aiter__(self):
+        return self.events()
+
+    async def close(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        await self._task
@@ -0,0 +1,68 @@
+import argparse
+import threading
+import time
+from server import ChatRoom
+
+
+def run_threads(target, chunks):
+    threads = [threading.Thread(target=target, args=(chunk, )) for chunk in chunks]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def sign_in_storm(users, threads, group_size):
+    chat = ChatRoom()
+    connections = [object() for _ in range(users)]
+    for c in connections:
+        chat.connect(c)
+    chunks = [connections[i::threads] for i in range(threads)]
+    failures = []
+
+    def sign_in(chunk):
+        for c in chunk:
+            success, _ = chat.sign_in(c, 'user{}'.format(id(c)))
+            if success is False:
+                failures.append(c)
+
+    def collide(chunk):
+        # every username is taken, all of these must fail
+        other = object()
+        chat.connect(other)
+        for c in chunk:
+            success, _ = chat.sign_in(other, 'user{}'.format(id(c)))
+            if success is True:
+                failures.append(c)
+        chat.disconnect(other)
+
+    def join(chunk):
+        for c in chunk:
+            chat.join(c, 'group{}'.format(id(c) // 16 % (users // group_size + 1)))
+
+    def leave(chunk):
+        for c in chunk:
+            chat.leave(c)
+            chat.sign_out(c)
+
+    results = {}
+    for name, target in (('signin', sign_in), ('collision', collide), ('join', join), ('leave+signout', leave)):
+        results[name] = run_threads(target, chunks)
+    assert len(failures) == 0, '{} unexpected results'.format(len(failures))
+    assert len(chat.user) == 0 and len(chat.group) == 0
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ChatRoom sign-in storm microbenchmark')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--group-size', type=int, default=100)
+    args = parser.parse_args()
+
+    results = sign_in_storm(args.users, args.threads, args.group_size)
+    print('{} users, {} threads'.format(args.users, args.threads))
+    for name, seconds in results.items():
+        print('{:>14}: {:8.3f} s {:>12.0f} ops/s'.format(name, seconds, args.users / seconds))
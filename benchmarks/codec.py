@@ -0,0 +1,76 @@
+import argparse
+import time
+from protocol import THTTP_Request, THTTP_Response, FrameDecoder, VERSION, VERSION_2, REQUEST_ID
+
+
+def per_frame(func, frames, repeat):
+    # best of repeat runs, the least disturbed by other processes
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(frames)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / frames * 1e9
+
+
+def encode_response(version):
+    # a fresh chat response per frame, as every send is broadcast
+    def run(frames):
+        for i in range(frames):
+            THTTP_Response(status_code='205', body='alice: hello').encode(version)
+    return run
+
+
+def decode_request(version):
+    # the server side of one request: parse, check and look up the request id
+    payload = FrameDecoder(version=version).feed(THTTP_Request(method='send', target='127.0.0.1', body='hello').encode(version))[0]
+
+    def run(frames):
+        for i in range(frames):
+            request = THTTP_Request(message=payload, version=version)
+            request.check()
+            request.get_header(REQUEST_ID)
+    return run
+
+
+def decode_response(version):
+    payload = FrameDecoder(version=version).feed(THTTP_Response(status_code='205', body='alice: hello').encode(version))[0]
+
+    def run(frames):
+        for i in range(frames):
+            response = THTTP_Response(message=payload, version=version)
+            response.check()
+            response.get_status_code()
+    return run
+
+
+def encode_error(version):
+    def run(frames):
+        for i in range(frames):
+            THTTP_Response(status_code='400', body='Corrupted request!').encode(version)
+    return run
+
+
+def encode_constant(version):
+    # the pre-serialized response the server sends instead
+    response = THTTP_Response.constant('400', 'Corrupted request!')
+
+    def run(frames):
+        for i in range(frames):
+            response.encode(version)
+    return run
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='THTTP per-frame encode/decode microbenchmark')
+    parser.add_argument('--frames', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = (('encode 205', encode_response), ('decode request', decode_request), ('decode 205', decode_response),
+             ('encode 400', encode_error), ('constant 400', encode_constant))
+    print('{} frames, ns per frame'.format(args.frames))
+    for name, case in cases:
+        for version in (VERSION, VERSION_2):
+            print('{:>14} {:<9}: {:8.0f}'.format(name, version, per_frame(case(version), args.frames, args.repeat)))
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from async_client import ChatClient
+from benchmarks.chatroom import sign_in_storm
+from benchmarks.codec import per_frame, encode_response, decode_request, decode_response
+from config import HOST
+from protocol import THTTP_Response, split_message, VERSION, VERSION_2
+
+# every result is a cost per operation in ns, lower is better
+
+
+def split_frames(version):
+    # split_message over chunks of 100 v1 frames
+    chunk = THTTP_Response(status_code='205', body='alice: hello').encode(version).decode() * 100
+
+    def run(frames):
+        for _ in range(frames // 100):
+            split_message(chunk)
+    return run
+
+
+def repr_response(version):
+    def run(frames):
+        for i in range(frames):
+            repr(THTTP_Response(status_code='205', body='alice: hello'))
+    return run
+
+
+def micro(frames, repeat):
+    results = {}
+    cases = (('split_message', split_frames), ('repr', repr_response))
+    for name, case in cases:
+        results['protocol.' + name] = per_frame(case(VERSION), frames, repeat)
+    for version in (VERSION, VERSION_2):
+        suffix = 'v1' if version == VERSION else 'v2'
+        results['protocol.parse_request.' + suffix] = per_frame(decode_request(version), frames, repeat)
+        results['protocol.parse_response.' + suffix] = per_frame(decode_response(version), frames, repeat)
+        results['protocol.encode_response.' + suffix] = per_frame(encode_response(version), frames, repeat)
+    return results
+
+
+def chatroom(users, repeat):
+    # one thread, so the numbers measure the operations and not the scheduler
+    best = {}
+    for _ in range(repeat):
+        for name, seconds in sign_in_storm(users, 1, 100).items():
+            ns = seconds / users * 1e9
+            best[name] = ns if name not in best else min(best[name], ns)
+    return {'chatroom.' + name: ns for name, ns in best.items()}
+
+
+async def fanout_run(port, members, messages, timeout):
+    # every member sends messages chat lines to one group, each reaches the other members
+    clients = [await ChatClient.connect(HOST, port) for _ in range(members)]
+    for i, client in enumerate(clients):
+        await client.signin('bench{}-{}'.format(os.getpid(), i))
+        await client.join('bench{}'.format(os.getpid()))
+    expected = (members - 1) * messages
+
+    async def receive(client):
+        count = 0
+        async for response in client:
+            if response.get_status_code() == '205':
+                count += 1
+                if count == expected:
+                    return
+
+    receivers = [asyncio.ensure_future(receive(client)) for client in clients]
+    start = time.perf_counter()
+    for n in range(messages):
+        for client in clients:
+            client.send('m{}'.format(n))
+    await asyncio.wait_for(asyncio.gather(*receivers), timeout)
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+    return elapsed / (members * expected) * 1e9
+
+
+def free_port():
+    # an ephemeral port nothing listens on, so a server left running elsewhere is never measured
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(server, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            socket.create_connection((HOST, port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start on {}:{}.'.format(HOST, port))
+
+
+def fanout(engine, members, messages, repeat, timeout=60):
+    # loopback through a real server.py process
+    port = free_port()
+    server = subprocess.Popen([sys.executable, 'server.py', '--port', str(port), '--engine', engine,
+                               '--log-level', 'warning'],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(server, port, 10)
+        return {'fanout.' + engine: min(asyncio.run(fanout_run(port, members, messages, timeout))
+                                        for _ in range(repeat))}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results, baseline, threshold):
+    # regressions: costs that grew by more than threshold (0.1 = 10%) over the baseline
+    regressions = []
+    for name, ns in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print('{:<32} {:>12.0f}'.format(name, ns))
+            continue
+        change = ns / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<32} {:>12.0f} {:>12.0f} {:>+8.1%}{}'.format(name, before, ns, change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Protocol, ChatRoom and loopback fan-out benchmark suite')
+    parser.add_argument('--frames', type=int, default=20000, help='iterations of each protocol benchmark')
+    parser.add_argument('--users', type=int, default=20000, help='users of the ChatRoom benchmark')
+    parser.add_argument('--members', type=int, default=20, help='members of the fan-out group')
+    parser.add_argument('--messages', type=int, default=50, help='chat lines each member sends in the fan-out benchmark, '
+                                                                 'at most the send burst in RATE_LIMITS')
+    parser.add_argument('--engines', default='thread,asyncio,reactor',
+                        help='server engines to run the fan-out benchmark on, empty to skip it')
+    parser.add_argument('--repeat', type=int, default=3, help='keep the best of this many runs')
+    parser.add_argument('--save', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='with --compare, fail when a cost grew by more than this fraction')
+    args = parser.parse_args()
+
+    results = micro(args.frames, args.repeat)
+    results.update(chatroom(args.users, args.repeat))
+    for engine in filter(None, args.engines.split(',')):
+        results.update(fanout(engine, args.members, args.messages, args.repeat))
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('{:<32} {:>12} {:>12} {:>8}'.format('ns per op', 'baseline', 'now', 'change'))
+    else:
+        print('{:<32} {:>12}'.format('ns per op', 'now'))
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2)
+    if len(regressions) > 0:
+        print('{} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
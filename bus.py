@@ -0,0 +1,297 @@
+import queue
+import threading
+from collections import deque
+from multiprocessing.connection import Listener, Client
+
+
+class Hub:
+    # the parent of the worker processes: owns the usernames and group members of every
+    # worker and relays chat and member changes to the workers with members in the group.
+    # Each worker opens two connections, rpc for its requests and events for what the hub
+    # relays to it. Relays are queued under the lock, so each worker sees them in order
+    def __init__(self, address, chat_log=None):
+        self.listener = Listener(address, family='AF_UNIX')
+        self.chat_log = chat_log
+        self.lock = threading.Lock()
+        # username -> worker
+        self.users = {}
+        # resume token -> (worker, username) of the sessions the workers hold
+        self.held = {}
+        # group -> {worker -> usernames in join order}
+        self.groups = {}
+        # worker -> queue of the events for its events connection
+        self.workers = {}
+
+    def serve(self):
+        while True:
+            conn = self.listener.accept()
+            kind, worker = conn.recv()
+            if kind == 'events':
+                with self.lock:
+                    events = self.workers.setdefault(worker, queue.SimpleQueue())
+                threading.Thread(target=self._send, args=(conn, events), daemon=True).start()
+            else:
+                threading.Thread(target=self._serve, args=(conn, worker), daemon=True).start()
+
+    def _send(self, conn, events):
+        while True:
+            message = events.get()
+            if message is None:
+                break
+            try:
+                conn.send(message)
+            except OSError:
+                break
+        conn.close()
+
+    def _serve(self, conn, worker):
+        # what this worker claimed, given back if it dies
+        members = set()
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == 'claim':
+                    with self.lock:
+                        taken = message[1] in self.users
+                        if not taken:
+                            self.users[message[1]] = worker
+                    conn.send(not taken)
+                elif kind == 'release':
+                    # only a name this worker got, a sign in that lost the race releases too
+                    with self.lock:
+                        if self.users.get(message[1]) == worker:
+                            del self.users[message[1]]
+                elif kind == 'hold':
+                    with self.lock:
+                        self.held[message[1]] = (worker, message[2])
+                elif kind == 'unhold':
+                    with self.lock:
+                        if self.held.get(message[1], (None, ))[0] == worker:
+                            del self.held[message[1]]
+                elif kind == 'forfeit':
+                    # a resume reached another worker than the one holding the session: the
+                    # name is free before the answer, the holder ends the session
+                    with self.lock:
+                        held = self.held.pop(message[1], None)
+                        if held is not None:
+                            if self.users.get(held[1]) == held[0]:
+                                del self.users[held[1]]
+                            self._queue(held[0], ('forfeit', '', held[1], message[1]))
+                    conn.send(held is not None)
+                elif kind == 'join':
+                    members.add(message[1:3])
+                    self._join(worker, *message[1:3])
+                elif kind == 'leave':
+                    members.discard(message[1:3])
+                    self._leave(worker, *message[1:3])
+                elif kind == 'send':
+                    with self.lock:
+                        self._relay(worker, message)
+                    self._log(*message)
+        except (EOFError, OSError):
+            pass
+        finally:
+            for group, username in members:
+                self._leave(worker, group, username)
+            with self.lock:
+                self.users = {username: owner for username, owner in self.users.items() if owner != worker}
+                self.held = {token: held for token, held in self.held.items() if held[0] != worker}
+                events = self.workers.pop(worker, None)
+            if events is not None:
+                events.put(None)
+
+    def _join(self, worker, group, username):
+        with self.lock:
+            workers = self.groups.setdefault(group, {})
+            if worker not in workers:
+                # the worker's first member, it gets the members of the other workers
+                others = [name for usernames in workers.values() for name in usernames]
+                workers[worker] = {}
+                self._queue(worker, ('members', group, others))
+            workers[worker][username] = None
+            self._relay(worker, ('join', group, username, ''))
+        self._log('join', group, username)
+
+    def _leave(self, worker, group, username):
+        with self.lock:
+            workers = self.groups.get(group, {})
+            usernames = workers.get(worker, {})
+            usernames.pop(username, None)
+            if len(usernames) == 0:
+                workers.pop(worker, None)
+            if len(workers) == 0:
+                self.groups.pop(group, None)
+            self._relay(worker, ('leave', group, username, ''))
+        self._log('leave', group, username)
+
+    def _relay(self, origin, message):
+        # with the lock held: to the other workers with members in the group, the origin
+        # has already handled it
+        for worker in self.groups.get(message[1], ()):
+            if worker != origin:
+                self._queue(worker, message)
+
+    def _queue(self, worker, message):
+        self.workers.setdefault(worker, queue.SimpleQueue()).put(message)
+
+    def _log(self, event, group, username, body=''):
+        if self.chat_log is not None:
+            self.chat_log.append(event, group, username, body)
+
+
+class Bus:
+    # a worker's side of the hub: usernames are claimed through it, join, leave and send
+    # events are published to it, and a thread hands the other workers' events to handle.
+    # The members of the other workers are mirrored for the groups with local members.
+    # lost runs once when the hub is gone, from the thread that notices
+    def __init__(self, address, worker, lost=None):
+        self.rpc = Client(address, family='AF_UNIX')
+        self.rpc.send(('rpc', worker))
+        self.events = Client(address, family='AF_UNIX')
+        self.events.send(('events', worker))
+        # rpc writes may block on a busy hub, readers never wait for send_lock; lock only
+        # guards the state below and is never held while writing
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # group -> local usernames, from this worker's own join and leave events
+        self.local = {}
+        # group -> usernames of the other workers, for groups with local members
+        self.remote = {}
+        # done callbacks of the claims and forfeits, the hub answers them in order
+        self._waiting = deque()
+        self._closed = False
+        self.lost = lost
+        threading.Thread(target=self._answer, daemon=True).start()
+
+    def start(self, handle):
+        thread = threading.Thread(target=self._receive, args=(handle, ), daemon=True)
+        thread.start()
+
+    def _receive(self, handle):
+        while True:
+            try:
+                message = self.events.recv()
+            except (EOFError, OSError):
+                self._close()
+                break
+            kind, group = message[0], message[1]
+            if kind == 'members':
+                # the other workers' members when this worker's first one joined
+                with self.lock:
+                    if group not in self.remote:
+                        continue
+                    old = self.remote[group]
+                    new = self.remote[group] = dict.fromkeys(message[2])
+                for username in old:
+                    if username not in new:
+                        handle(('leave', group, username, ''))
+                for username in new:
+                    if username not in old:
+                        handle(('join', group, username, ''))
+                continue
+            if kind in ('join', 'leave'):
+                with self.lock:
+                    usernames = self.remote.get(group)
+                    if usernames is None:
+                        continue
+                    if kind == 'join':
+                        usernames[message[2]] = None
+                    else:
+                        usernames.pop(message[2], None)
+            handle(message)
+
+    def _answer(self):
+        while True:
+            try:
+                ok = self.rpc.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                done = self._waiting.popleft()
+            done(ok)
+        self._close()
+
+    def _close(self):
+        # the hub is gone, so is every answer waiting for it
+        with self.lock:
+            first = not self._closed
+            self._closed = True
+            waiting = list(self._waiting)
+            self._waiting.clear()
+        for done in waiting:
+            done(None)
+        if first and self.lost is not None:
+            self.lost()
+
+    def _post(self, *message):
+        with self.send_lock:
+            self.rpc.send(message)
+
+    def _ask(self, message, done):
+        # done gets the hub's answer, None when the hub is gone. It runs on the thread
+        # reading the answers; without done the caller waits for the answer
+        if done is None:
+            answer = []
+            answered = threading.Event()
+            self._ask(message, lambda ok: (answer.append(ok), answered.set()))
+            answered.wait()
+            return answer[0]
+        # queued before the write, the answer may come before rpc.send returns
+        failed = True
+        with self.send_lock:
+            with self.lock:
+                if not self._closed:
+                    self._waiting.append(done)
+                    failed = False
+            if not failed:
+                try:
+                    self.rpc.send(message)
+                except OSError:
+                    with self.lock:
+                        # still queued unless the reader failed it at the hub's end
+                        failed = done in self._waiting
+                        if failed:
+                            self._waiting.remove(done)
+        if failed:
+            done(None)
+
+    def claim(self, username, done=None):
+        # True once the name is claimed, False when a user of any worker has it
+        return self._ask(('claim', username), done)
+
+    def release(self, username):
+        self._post('release', username)
+
+    def hold(self, token, username):
+        self._post('hold', token, username)
+
+    def unhold(self, token):
+        self._post('unhold', token)
+
+    def forfeit(self, token, done=None):
+        # True when another worker held a session under token, its name is free then and
+        # the holder gets a forfeit event to end the session
+        return self._ask(('forfeit', token), done)
+
+    def members(self, group):
+        # every worker's members of group that this worker knows of, local ones first
+        with self.lock:
+            usernames = dict(self.local.get(group, {}))
+            usernames.update(self.remote.get(group, {}))
+        return list(usernames)
+
+    def publish(self, event, group, username, body=''):
+        # join, leave or send, in the order of the worker's other requests
+        with self.send_lock:
+            with self.lock:
+                if event == 'join':
+                    self.local.setdefault(group, {})[username] = None
+                    self.remote.setdefault(group, {})
+                elif event == 'leave' and group in self.local:
+                    local = self.local[group]
+                    local.pop(username, None)
+                    if len(local) == 0:
+                        del self.local[group]
+                        self.remote.pop(group, None)
+            self.rpc.send((event, group, username, body))
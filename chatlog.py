@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+from queue import Queue, Empty
+from config import LOG_SEGMENT_SIZE, LOG_COMMIT_INTERVAL, LOG_SEGMENTS
+
+SEGMENT_SUFFIX = '.log'
+
+
+class ChatLog:
+    # append-only log of send/join/leave events split into size-rotated segments,
+    # a background writer batches the records and fsyncs once per commit window. Only the
+    # newest max_segments segments are kept, older ones are deleted as new ones start
+    def __init__(self, directory, segment_size=LOG_SEGMENT_SIZE, commit_interval=LOG_COMMIT_INTERVAL,
+                 max_segments=LOG_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        segments = segment_paths(directory)
+        self._index = int(os.path.basename(segments[-1])[: -len(SEGMENT_SUFFIX)]) if segments else 0
+        path = self._segment_path(self._index)
+        if segments:
+            truncate_torn_line(path)
+        self._file = open(path, 'ab')
+        self._retire()
+        self._queue = Queue()
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def _segment_path(self, index):
+        return os.path.join(self.directory, '{:020d}{}'.format(index, SEGMENT_SUFFIX))
+
+    def append(self, event, group, username='', body=''):
+        # O(1) for the caller, encoding and disk io happen on the writer
+        self._queue.put((time.time(), event, group, username, body))
+
+    def close(self):
+        # commit whatever is queued and stop the writer
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            # group commit: gather everything that arrives within the window
+            deadline = time.monotonic() + self.commit_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if len(batch) > 0:
+                self._commit(batch)
+        self._file.close()
+
+    def _commit(self, batch):
+        lines = []
+        for (t, event, group, username, body) in batch:
+            record = {'t': t, 'e': event, 'g': group, 'u': username, 'b': body}
+            lines.append(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+        self._file.write(b''.join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._file.tell() >= self.segment_size:
+            self._file.close()
+            self._index += 1
+            self._file = open(self._segment_path(self._index), 'ab')
+            self._retire()
+
+    def _retire(self):
+        for path in segment_paths(self.directory)[: -self.max_segments]:
+            os.remove(path)
+
+
+def truncate_torn_line(path):
+    # cut a partial last record left by a crash, so the next record starts on its own line
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 4096)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def segment_paths(directory):
+    names = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_records(directory):
+    # yield the logged records in order, a torn last line from a crash is skipped
+    if not os.path.isdir(directory):
+        return
+    for path in segment_paths(directory):
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
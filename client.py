@@ -1,10 +1,36 @@
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
+from PyQt5.QtGui import QTextCursor
 from mainwindow import Ui_MainWindow
 import socket
 import sys
-from config import HOST, PORT, BUFSIZE
-from protocol import THTTP_Request, THTTP_Response, split_message
+from config import HOST, PORT, BUFSIZE, CHAT_SCROLLBACK, CHAT_FLUSH_INTERVAL, HEARTBEAT_INTERVAL
+from protocol import THTTP_Request, THTTP_Response, FrameDecoder, VERSION, VERSION_2, PREFACE, \
+    ACCEPT_ENCODING, ZLIB, MEMBER_UPDATES, DELTA
+
+
+def negotiate(sock):
+    # offer v2 framing, an old THTTP/1.1 server closes the connection on the preface
+    sock.sendall(PREFACE)
+    reply = b''
+    while len(reply) < len(PREFACE):
+        data = sock.recv(len(PREFACE) - len(reply))
+        if not data:
+            break
+        reply += data
+    return VERSION_2 if reply == PREFACE else VERSION
+
+
+def connect(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(address)
+    version = negotiate(sock)
+    if version == VERSION:
+        # reconnect and speak v1
+        sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(address)
+    return sock, version
 
 
 class Receiver(QThread):
@@ -14,27 +40,33 @@ class Receiver(QThread):
     signal_group = pyqtSignal(str)
     signal_member = pyqtSignal(str)
 
-    def __init__(self, socket, parent=None):
+    def __init__(self, socket, version=VERSION, parent=None):
         super(Receiver, self).__init__(parent)
         self.working = True
         self.socket = socket
+        self.version = version
+        # the group's usernames in join order, kept up to date from 208 and 209 deltas
+        self.members = {}
 
     def __det__(self):
         self.working = False
         self.wait()
 
     def run(self):
+        decoder = FrameDecoder(version=self.version)
         # receive
         while True:
             try:
-                message = self.socket.recv(BUFSIZE).decode()
+                data = self.socket.recv(BUFSIZE)
+                if not data:
+                    break
                 # print('send {}'.format(message))
-                for response_message in split_message(message):
-                    response = THTTP_Response(message=response_message)
+                for response_message in decoder.feed(data):
+                    response = THTTP_Response(message=response_message, version=self.version)
                     if response.check() is True:
-                        print(str(response))
+                        # print(str(response))
                         # not chat, show short response message
-                        if response.get_status_code() != '205':
+                        if response.get_status_code() not in ('205', '207', '208', '209'):
                             self.signal_chat.emit(str(response))
                         # OK response
                         if response.get_status_code() == '200':
@@ -46,7 +78,15 @@ class Receiver(QThread):
                         elif response.get_status_code() == '203':
                             self.signal_group.emit('')
                         elif response.get_status_code() == '204':
-                            self.signal_member.emit(response.body.strip(','))
+                            self.members = dict.fromkeys(name for name in response.body.split(',') if name != '')
+                            self.signal_member.emit(','.join(self.members))
+                        elif response.get_status_code() == '208':
+                            self.members.update(dict.fromkeys(response.body.split(',')))
+                            self.signal_member.emit(','.join(self.members))
+                        elif response.get_status_code() == '209':
+                            for name in response.body.split(','):
+                                self.members.pop(name, None)
+                            self.signal_member.emit(','.join(self.members))
                         elif response.get_status_code() == '205':
                             self.signal_chat.emit(response.body)
 
@@ -56,20 +96,35 @@ class Receiver(QThread):
 
 
 class MyWindow(QMainWindow, Ui_MainWindow):
-    def __init__(self, socket):
+    def __init__(self, socket, version=VERSION):
         super(MyWindow, self).__init__()
         self.setupUi(self)
 
         # socket
         self.socket = socket
+        self.version = version
         # receive messages
-        self.receiver = Receiver(socket)
+        self.receiver = Receiver(socket, version)
         self.receiver.signal_chat.connect(self.set_chat)
         self.receiver.signal_username.connect(self.set_username)
         self.receiver.signal_group.connect(self.set_group)
         self.receiver.signal_member.connect(self.set_member)
         self.receiver.start()
 
+        # chat lines are appended in batches, at most once per CHAT_FLUSH_INTERVAL ms
+        self.chat_window.document().setMaximumBlockCount(CHAT_SCROLLBACK)
+        self.pending_chat = []
+        self.chat_timer = QTimer(self)
+        self.chat_timer.setSingleShot(True)
+        self.chat_timer.setInterval(CHAT_FLUSH_INTERVAL)
+        self.chat_timer.timeout.connect(self.flush_chat)
+
+        # keep the connection alive past the server's idle timeout
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.setInterval(HEARTBEAT_INTERVAL * 1000)
+        self.heartbeat_timer.timeout.connect(self.ping)
+        self.heartbeat_timer.start()
+
         # buttons
         self.sign_in_button.clicked.connect(lambda: self.sign_in())
         self.sign_out_button.clicked.connect(lambda: self.sign_out())
@@ -77,33 +132,38 @@ class MyWindow(QMainWindow, Ui_MainWindow):
         self.leave_button.clicked.connect(lambda: self.leave())
         self.send_button.clicked.connect(lambda: self.send())
 
-    def _send(self, message):
-        self.socket.sendall(message.encode())
+    def _send(self, request):
+        self.socket.sendall(request.encode(self.version))
 
     def sign_in(self):
         dialog = QInputDialog.getText(self, "Sign in", "Username")
         if dialog[1] is True and dialog[0] != '':
-            request = THTTP_Request(method='signin', target=HOST, headers=[], body=dialog[0])
+            # the Receiver applies member deltas; offer compression of large chat bodies,
+            # only THTTP/2 can carry it
+            headers = [(MEMBER_UPDATES, DELTA)]
+            if self.version == VERSION_2:
+                headers.append((ACCEPT_ENCODING, ZLIB))
+            request = THTTP_Request(method='signin', target=HOST, headers=headers, body=dialog[0])
             # print(str(request))
             if request.check() is True:
-                self._send(repr(request))
+                self._send(request)
 
     def sign_out(self):
         request = THTTP_Request(method='signout', target=HOST, headers=[], body='')
         if request.check() is True:
-            self._send(repr(request))
+            self._send(request)
 
     def join(self):
         dialog = QInputDialog.getText(self, "Create / Join", 'Group name')
         if dialog[1] is True and dialog[0] != '':
             request = THTTP_Request(method='join', target=HOST, headers=[], body=dialog[0])
             if request.check() is True:
-                self._send(repr(request))
+                self._send(request)
 
     def leave(self):
         request = THTTP_Request(method='leave', target=HOST, headers=[], body='')
         if request.check() is True:
-            self._send(repr(request))
+            self._send(request)
 
     def send(self):
         text = self.message_input.toPlainText()
@@ -111,7 +171,7 @@ class MyWindow(QMainWindow, Ui_MainWindow):
         if text != '':
             request = THTTP_Request(method='send', target=HOST, headers=[], body=text)
             if request.check() is True:
-                self._send(repr(request))
+                self._send(request)
 
     def set_username(self, username):
         globals()['username'] = username
@@ -121,32 +181,41 @@ class MyWindow(QMainWindow, Ui_MainWindow):
         globals()['group'] = group
         self.group_window.setText(group)
 
+    def ping(self):
+        self._send(THTTP_Request(method='ping', target=HOST))
+
     def set_member(self, member):
         self.member_window.setText(member)
 
     def set_chat(self, message):
-        text = self.chat_window.toPlainText()
-        self.chat_window.setPlainText(text + message + '\n')
-
+        self.pending_chat.append(message)
+        if not self.chat_timer.isActive():
+            self.chat_timer.start()
+
+    def flush_chat(self):
+        # one insert at the end of the document, the scrollback cap drops the oldest lines
+        text = '\n'.join(self.pending_chat) + '\n'
+        self.pending_chat = []
         cursor = self.chat_window.textCursor()
-        pos = len(self.chat_window.toPlainText())
-        cursor.setPosition(pos - 1)
-        self.chat_window.ensureCursorVisible()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
         self.chat_window.setTextCursor(cursor)
+        self.chat_window.ensureCursorVisible()
 
 
 if __name__ == '__main__':
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = None
     username = ''
     group = ''
 
     try:
-        sock.connect((HOST, PORT))
+        sock, version = connect((HOST, PORT))
         app = QApplication(sys.argv)
-        myshow = MyWindow(sock)
+        myshow = MyWindow(sock, version)
         myshow.show()
         sys.exit(app.exec_())
     except Exception as e:
         print(e)
 
-    sock.close()
+    if sock is not None:
+        sock.close()
@@ -1,5 +1,99 @@
 HOST = '127.0.0.1'
 PORT = 65432
 BUFSIZE = 1024
+# thread engine: connection threads grow on demand up to MAX_THREAD and shrink back to
+# MIN_THREAD after THREAD_IDLE_TIMEOUT idle seconds; CONNECTION_QUEUE_SIZE more wait for
+# a thread, beyond that a connection is refused with 402
 MAX_THREAD = 1000
+MIN_THREAD = 8
+THREAD_IDLE_TIMEOUT = 30
+THREAD_STACK_SIZE = 256 * 1024
+CONNECTION_QUEUE_SIZE = 64
 LENGTH_SIZE = 3
+# server engine: 'thread', 'asyncio' or 'reactor'
+ENGINE = 'thread'
+# listen backlog of the asyncio and reactor engines
+ASYNC_BACKLOG = 4096
+# reactor engine: connections accepted per loop pass at most
+ACCEPT_BATCH = 64
+# largest v2 frame a peer may send, v1 frames stop at 10 ** LENGTH_SIZE - 1 characters
+MAX_FRAME_SIZE = 1 << 24
+# high-water marks of the frames and bytes waiting to be written to one connection,
+# past them OUTBOUND_POLICY applies: 'drop-oldest' drops its oldest queued chat,
+# 'drop-newest' drops the new frame, 'disconnect' evicts the slow consumer
+OUTBOUND_QUEUE_SIZE = 1024
+OUTBOUND_HIGH_WATER = 1024 * 1024
+OUTBOUND_POLICY = 'drop-oldest'
+# longest chat line a send may carry, in characters, so its frame always fits OUTBOUND_HIGH_WATER
+MAX_CHAT_LENGTH = 64 * 1024
+# locks guarding the ChatRoom username index and group member sets
+LOCK_STRIPES = 64
+# chat messages kept per group and replayed on join, capped by count and by bytes
+HISTORY_SIZE = 50
+HISTORY_BYTES = 64 * 1024
+# groups without members whose history is kept, the least recently used are forgotten
+IDLE_GROUPS = 1024
+# durable chat log: None disables it, segments rotate at LOG_SEGMENT_SIZE bytes and only
+# the newest LOG_SEGMENTS are kept, records are fsynced together once per LOG_COMMIT_INTERVAL seconds
+LOG_DIR = None
+LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+LOG_SEGMENTS = 4
+LOG_COMMIT_INTERVAL = 0.05
+# local port serving GET /stats as JSON, None disables it
+STATS_PORT = None
+# diagnostic logging: 'debug' also logs requests, one in every LOG_SAMPLE of them
+LOG_LEVEL = 'info'
+LOG_SAMPLE = 1
+LOG_QUEUE_SIZE = 65536
+# client chat window: lines kept, and ms between batched updates
+CHAT_SCROLLBACK = 10000
+CHAT_FLUSH_INTERVAL = 16
+# thread engine: threads running requests that carry a request id concurrently,
+# 0 keeps them in order on the connection thread, which is cheaper for plain chat
+REQUEST_THREAD = 0
+# THTTP/2 compression: bodies of at least COMPRESS_THRESHOLD bytes, zlib level
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 6
+# token bucket per connection and method: (requests per second, burst)
+RATE_LIMITS = {
+    'signin': (1, 5),
+    'signout': (1, 5),
+    'join': (2, 10),
+    'leave': (2, 10),
+    'send': (50, 100),
+    'stats': (1, 5),
+    'ping': (1, 5),
+    'resume': (1, 5),
+}
+# connections that have pinged once and then send nothing, not even a ping, for
+# IDLE_TIMEOUT seconds are closed; clients ping every HEARTBEAT_INTERVAL seconds
+IDLE_TIMEOUT = 60
+REAPER_TICK = 1.0
+HEARTBEAT_INTERVAL = 20
+# a signed in session whose connection drops is held RESUME_GRACE seconds for a resume
+# request, still a member of its group; 0 signs it out at once
+RESUME_GRACE = 30
+# member joins and leaves are announced to the group at most once per MEMBER_DEBOUNCE seconds
+MEMBER_DEBOUNCE = 0.05
+# frames queued for a connection are written together with one sendmsg, up to these
+# limits; WRITE_DELAY > 0 waits that many seconds for more frames first
+WRITE_DELAY = 0.0
+WRITE_BATCH_BYTES = 256 * 1024
+WRITE_BATCH_FRAMES = 1024
+TCP_NODELAY = True
+# TCP keepalive for connections that never ping: the kernel probes a peer silent for
+# KEEPALIVE_IDLE seconds every KEEPALIVE_INTERVAL seconds and resets the connection after
+# KEEPALIVE_COUNT unanswered probes, so a half-open one ends like any dropped connection
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+# server processes accepting on PORT, more than 1 shards connections with SO_REUSEPORT
+WORKERS = 1
+# cluster of nodes linked over TCP: this node's HOST:PORT for peer links, the other
+# nodes' and an optional shared key; a lost link is redialled every PEER_RETRY seconds
+# and a username claim waits PEER_TIMEOUT seconds for its owner node
+CLUSTER = None
+PEERS = ''
+CLUSTER_KEY = None
+PEER_RETRY = 1.0
+PEER_TIMEOUT = 2.0
@@ -0,0 +1,330 @@
+import ipaddress
+import itertools
+import json
+import threading
+import time
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from config import PEER_RETRY, PEER_TIMEOUT
+
+
+def node_id(address):
+    host, port = address
+    return '{}:{}'.format(host, port)
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def is_loopback(address):
+    # only this host can reach a loopback address, others need the cluster key
+    host, _ = address
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+class Peer:
+    # one TCP link to another node, messages are JSON lists
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, *message):
+        try:
+            with self.lock:
+                self.conn.send_bytes(json.dumps(message).encode())
+        except (OSError, ValueError):
+            pass
+
+    def recv(self):
+        return json.loads(self.conn.recv_bytes())
+
+
+class Federation:
+    # this node's side of a cluster of servers linked over TCP, one link per pair of nodes.
+    # Nodes tell each other which groups they have members in, chat and member changes of
+    # a group go once to each node subscribed to it, never once per remote member. Every
+    # username has an owner node picked by hash, signing in anywhere claims it there. A
+    # node claims its users' names again whenever the link to their owner comes up, a name
+    # the owner gave to someone else meanwhile is signed out here
+    def __init__(self, address, peers, authkey=None):
+        self.address = address
+        self.name = node_id(address)
+        self.authkey = authkey
+        self.peer_addresses = {node_id(peer): peer for peer in peers}
+        self.nodes = sorted([self.name] + list(self.peer_addresses))
+        self.lock = threading.Lock()
+        # name -> Peer, for the links that are up
+        self.peers = {}
+        # group -> local usernames, from this node's own join and leave events
+        self.local = {}
+        # group -> {peer name -> usernames} of the peers' members, for groups with local members
+        self.remote = {}
+        # group -> names of the peers with members in it
+        self.interest = {}
+        # usernames this node owns -> name of the node that signed them in
+        self.claims = {}
+        # usernames of this node's users that other nodes own -> the owner's name
+        self.granted = {}
+        self._ids = itertools.count()
+        # call id -> (owner, deadline, username, done) of the claims waiting for an answer
+        self._calls = {}
+        self.handle = None
+
+    def start(self, handle):
+        # handle gets the (event, group, username, body) events of the other nodes
+        self.handle = handle
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, args=(listener, ), daemon=True).start()
+        # the node with the smaller name dials, so each pair has one link
+        for name, address in self.peer_addresses.items():
+            if self.name < name:
+                threading.Thread(target=self._dial, args=(name, address), daemon=True).start()
+        threading.Thread(target=self._expire, daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            threading.Thread(target=self._run, args=(None, conn), daemon=True).start()
+
+    def _dial(self, name, address):
+        while True:
+            try:
+                conn = Client(address, authkey=self.authkey)
+            except (OSError, EOFError, AuthenticationError):
+                time.sleep(PEER_RETRY)
+                continue
+            self._run(name, conn)
+            time.sleep(PEER_RETRY)
+
+    def _run(self, name, conn):
+        peer = Peer(name, conn)
+        try:
+            peer.send('hello', self.name)
+            kind, peer.name = peer.recv()
+            if kind != 'hello' or peer.name not in self.peer_addresses:
+                return
+            with self.lock:
+                self.peers[peer.name] = peer
+                groups = [group for group, usernames in self.local.items() if len(usernames) > 0]
+                # the peer lost them with the link, or all of its claims with a restart
+                usernames = [username for username, owner in self.granted.items() if owner == peer.name]
+            for group in groups:
+                peer.send('subscribe', group)
+            if len(usernames) > 0:
+                peer.send('reclaim', usernames)
+            while True:
+                self._receive(peer, peer.recv())
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+            self._lost(peer)
+
+    def _lost(self, peer):
+        # its members left every group here and its usernames are free again
+        left = []
+        with self.lock:
+            if self.peers.get(peer.name) is not peer:
+                return
+            del self.peers[peer.name]
+            for group, names in self.interest.items():
+                names.discard(peer.name)
+            for group, members in self.remote.items():
+                left.extend((group, username) for username in members.pop(peer.name, ()))
+            for username in [username for username, origin in self.claims.items() if origin == peer.name]:
+                del self.claims[username]
+            calls = [call for call, (owner, _, _, _) in self._calls.items() if owner == peer.name]
+            unanswered = [self._calls.pop(call) for call in calls]
+        for group, username in left:
+            self.handle(('leave', group, username, ''))
+        for waiting in unanswered:
+            self._answer(waiting, None)
+
+    def _expire(self):
+        # claims whose owner node did not answer within PEER_TIMEOUT; should the answer still
+        # come, the release that follows on the same link gives the name back
+        while True:
+            time.sleep(PEER_TIMEOUT / 4)
+            now = time.monotonic()
+            with self.lock:
+                calls = [call for call, (_, deadline, _, _) in self._calls.items() if deadline <= now]
+                expired = [self._calls.pop(call) for call in calls]
+            for waiting in expired:
+                peer = self.peers.get(waiting[0])
+                if peer is not None:
+                    peer.send('release', waiting[2])
+                self._answer(waiting, None)
+
+    def _answer(self, waiting, ok):
+        owner, _, username, done = waiting
+        if ok is not True:
+            with self.lock:
+                if self.granted.get(username) == owner:
+                    del self.granted[username]
+        done(ok)
+
+    def _receive(self, peer, message):
+        kind = message[0]
+        if kind == 'send':
+            self.handle(tuple(message))
+        elif kind in ('join', 'leave'):
+            _, group, username, _ = message
+            with self.lock:
+                members = self.remote.get(group)
+                if members is None:
+                    return
+                if kind == 'join':
+                    members.setdefault(peer.name, {})[username] = None
+                else:
+                    members.get(peer.name, {}).pop(username, None)
+            self.handle(tuple(message))
+        elif kind == 'subscribe':
+            group = message[1]
+            with self.lock:
+                self.interest.setdefault(group, set()).add(peer.name)
+                usernames = list(self.local.get(group, ()))
+            if len(usernames) > 0:
+                peer.send('members', group, usernames)
+        elif kind == 'unsubscribe':
+            with self.lock:
+                self.interest.get(message[1], set()).discard(peer.name)
+        elif kind == 'members':
+            _, group, usernames = message
+            with self.lock:
+                members = self.remote.get(group)
+                if members is None:
+                    return
+                members.setdefault(peer.name, {}).update(dict.fromkeys(usernames))
+            for username in usernames:
+                self.handle(('join', group, username, ''))
+        elif kind == 'claim':
+            _, call, username = message
+            peer.send('claimed', call, self._claim(username, peer.name))
+        elif kind == 'release':
+            with self.lock:
+                if self.claims.get(message[1]) == peer.name:
+                    del self.claims[message[1]]
+        elif kind == 'reclaim':
+            # the first claim wins, the peer signs out its users whose names are taken
+            with self.lock:
+                taken = [username for username in message[1] if self.claims.setdefault(username, peer.name) != peer.name]
+            for username in taken:
+                peer.send('unclaimed', username)
+        elif kind == 'unclaimed':
+            # only the owner of a name can take it back
+            if peer.name != self.owner(message[1]):
+                return
+            with self.lock:
+                if self.granted.get(message[1]) == peer.name:
+                    del self.granted[message[1]]
+            self.handle(('evict', '', message[1], ''))
+        elif kind == 'claimed':
+            _, call, ok = message
+            with self.lock:
+                waiting = self._calls.pop(call, None)
+            if waiting is not None:
+                self._answer(waiting, ok)
+
+    def owner(self, username):
+        return self.nodes[zlib.crc32(username.encode()) % len(self.nodes)]
+
+    def _claim(self, username, origin):
+        with self.lock:
+            if username in self.claims:
+                return False
+            self.claims[username] = origin
+            return True
+
+    def claim(self, username, done=None):
+        # done(True) once the name is claimed, done(False) when a user of any node has it and
+        # done(None) when its owner node is unreachable. It runs at once for a name this node
+        # owns, else on the link thread; without done the caller waits for the answer
+        if done is None:
+            answer = []
+            answered = threading.Event()
+            self.claim(username, lambda ok: (answer.append(ok), answered.set()))
+            answered.wait()
+            return answer[0]
+        owner = self.owner(username)
+        if owner == self.name:
+            done(self._claim(username, self.name))
+            return
+        call = next(self._ids)
+        with self.lock:
+            peer = self.peers.get(owner)
+            if peer is not None:
+                self._calls[call] = (owner, time.monotonic() + PEER_TIMEOUT, username, done)
+                # from now on, so a release before the answer is not undone by it
+                self.granted[username] = owner
+        if peer is None:
+            done(None)
+            return
+        peer.send('claim', call, username)
+
+    def release(self, username):
+        owner = self.owner(username)
+        if owner == self.name:
+            # the claim of a sign in that lost the race is another node's
+            with self.lock:
+                if self.claims.get(username) == self.name:
+                    del self.claims[username]
+            return
+        with self.lock:
+            self.granted.pop(username, None)
+            peer = self.peers.get(owner)
+        if peer is not None:
+            peer.send('release', username)
+
+    def hold(self, token, username):
+        pass
+
+    def unhold(self, token):
+        pass
+
+    def forfeit(self, token, done=None):
+        # a session is only resumed on the node holding it, the client picks the node
+        if done is None:
+            return False
+        done(False)
+
+    def members(self, group):
+        # every node's members of group that this node knows of, local ones first
+        with self.lock:
+            usernames = dict(self.local.get(group, {}))
+            for members in self.remote.get(group, {}).values():
+                usernames.update(members)
+        return list(usernames)
+
+    def publish(self, event, group, username, body=''):
+        # a local join, leave or send, passed on to the nodes with members in the group
+        subscribe = unsubscribe = False
+        with self.lock:
+            if event == 'join':
+                local = self.local.setdefault(group, {})
+                subscribe = len(local) == 0
+                local[username] = None
+                self.remote.setdefault(group, {})
+            elif event == 'leave' and group in self.local:
+                local = self.local[group]
+                local.pop(username, None)
+                unsubscribe = len(local) == 0
+                if unsubscribe:
+                    del self.local[group]
+                    self.remote.pop(group, None)
+            targets = [self.peers[name] for name in self.interest.get(group, ()) if name in self.peers]
+            everyone = list(self.peers.values())
+        for peer in targets:
+            peer.send(event, group, username, body)
+        if subscribe or unsubscribe:
+            for peer in everyone:
+                peer.send('subscribe' if subscribe else 'unsubscribe', group)
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from async_client import ChatClient
+from config import HOST, PORT
+from protocol import VERSION, VERSION_2
+
+
+def group_sizes(spec, users, rng):
+    # fixed:N, uniform:LOW:HIGH or pareto:ALPHA:MAX, drawn until every user has a group
+    kind, *params = spec.split(':')
+    sizes = []
+    while sum(sizes) < users:
+        if kind == 'fixed':
+            size = int(params[0])
+        elif kind == 'uniform':
+            size = rng.randint(int(params[0]), int(params[1]))
+        elif kind == 'pareto':
+            size = min(int(rng.paretovariate(float(params[0]))), int(params[1]))
+        else:
+            raise ValueError('Unknown group size distribution {}.'.format(spec))
+        sizes.append(max(1, min(size, users - sum(sizes))))
+    return sizes
+
+
+def percentile(ordered, p):
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class User:
+    # one simulated client, fan-out latency is measured from timestamps in the chat body
+    def __init__(self, test, name, group):
+        self.test = test
+        self.name = name
+        self.group = group
+        self.task = None
+        self.client = None
+
+    async def connect(self):
+        self.client = await ChatClient.connect(self.test.host, self.test.port, self.test.version)
+        if self.client.version != self.test.version:
+            raise ConnectionError('Server does not speak {}.'.format(self.test.version))
+
+    async def start(self):
+        # join waits for the sign in, the server may run requests of a connection concurrently
+        for response in (await self.client.signin(self.name), await self.client.join(self.group)):
+            if response.get_status_code() not in ('200', '202'):
+                self.test.errors += 1
+
+    async def receive(self):
+        async for response in self.client:
+            if response.get_status_code() == '205':
+                self.test.deliveries += 1
+                # "sender: lt:run:seq:time", only messages of this run once measuring
+                _, _, text = response.body.partition(': ')
+                fields = text.split(':')
+                if self.test.measuring and len(fields) == 4 and fields[1] == self.test.run:
+                    self.test.latencies.append((time.time_ns() - int(fields[3])) / 1e6)
+
+    async def send_loop(self, rate, deadline):
+        seq = 0
+        interval = 1.0 / rate
+        # spread the first message over one interval so users do not fire in lockstep
+        await asyncio.sleep(random.random() * interval)
+        while time.monotonic() < deadline:
+            self.client.send('lt:{}:{}:{}'.format(self.test.run, seq, time.time_ns())).add_done_callback(self.replied)
+            seq += 1
+            await asyncio.sleep(interval)
+
+    def replied(self, future):
+        # the sender's copy of a sent message, 401 when the server's send rate limit refused it
+        if future.exception() is not None:
+            return
+        status = future.result().get_status_code()
+        if status == '205':
+            self.test.sent += 1
+        elif status == '401':
+            self.test.throttled += 1
+        else:
+            self.test.errors += 1
+
+    def close(self):
+        if self.client is not None:
+            self.client.writer.close()
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.host = args.host
+        self.port = args.port
+        self.version = VERSION if args.v1 else VERSION_2
+        self.args = args
+        self.run = os.urandom(4).hex()
+        self.users = []
+        self.sent = 0
+        self.throttled = 0
+        self.deliveries = 0
+        self.errors = 0
+        self.latencies = []
+        self.measuring = False
+
+    async def start_users(self):
+        rng = random.Random(self.args.seed)
+        sizes = group_sizes(self.args.groups, self.args.users, rng)
+        for g, size in enumerate(sizes):
+            for _ in range(size):
+                self.users.append(User(self, 'lt{}-{}'.format(self.run, len(self.users)), 'lt{}-g{}'.format(self.run, g)))
+        # bounded connect concurrency keeps the listen backlog from overflowing
+        limit = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def start(user):
+            async with limit:
+                await user.connect()
+            user.task = asyncio.get_running_loop().create_task(user.receive())
+            await user.start()
+
+        await asyncio.gather(*(start(user) for user in self.users))
+        return sizes
+
+    async def main(self):
+        start = time.monotonic()
+        sizes = await self.start_users()
+        setup = time.monotonic() - start
+
+        senders = self.users[: max(1, int(len(self.users) * self.args.senders))]
+        self.measuring = True
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        await asyncio.gather(*(user.send_loop(self.args.rate, deadline) for user in senders))
+        # let in-flight deliveries arrive
+        await asyncio.sleep(self.args.drain)
+        elapsed = time.monotonic() - start
+        self.measuring = False
+        for user in self.users:
+            user.close()
+
+        ordered = sorted(self.latencies)
+        return {
+            'version': self.version,
+            'users': len(self.users),
+            'groups': len(sizes),
+            'max_group_size': max(sizes),
+            'senders': len(senders),
+            'setup_seconds': round(setup, 3),
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'deliveries': self.deliveries,
+            'errors': self.errors,
+            'send_rate': round(self.sent / elapsed, 1),
+            'delivery_rate': round(self.deliveries / elapsed, 1),
+            'latency_ms': {
+                'p50': round(percentile(ordered, 0.50), 3),
+                'p99': round(percentile(ordered, 0.99), 3),
+                'p999': round(percentile(ordered, 0.999), 3),
+                'max': round(ordered[-1], 3) if ordered else 0.0,
+            },
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless chat room load generator')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', default='fixed:10',
+                        help='group size distribution: fixed:N, uniform:LOW:HIGH or pareto:ALPHA:MAX')
+    parser.add_argument('--senders', type=float, default=1.0, help='fraction of users that send')
+    parser.add_argument('--rate', type=float, default=1.0, help='messages per second per sender')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--drain', type=float, default=1.0, help='seconds to wait for in-flight deliveries')
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--v1', action='store_true', help='speak THTTP/1.1 instead of THTTP/2')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = asyncio.run(LoadTest(args).main())
+    print(json.dumps(results, indent=2))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,87 @@
+import itertools
+import sys
+import threading
+import time
+from queue import Queue, Full
+from config import LOG_LEVEL, LOG_SAMPLE, LOG_QUEUE_SIZE
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class Logger:
+    # structured records go through a bounded queue to one writer thread, callers never
+    # wait on the output stream and records that do not fit in the queue are dropped
+    def __init__(self, level=LOG_LEVEL, sample=LOG_SAMPLE, stream=None, queue_size=LOG_QUEUE_SIZE):
+        self.stream = stream
+        self.dropped = 0
+        self._queue = Queue(queue_size)
+        self._counter = itertools.count()
+        self.configure(level, sample)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def configure(self, level=LOG_LEVEL, sample=LOG_SAMPLE):
+        self.level = LEVELS[level]
+        # per-message events are kept one in every sample
+        self.sample = max(1, sample)
+        self.tracing = self.level <= LEVELS['debug']
+
+    def log(self, level, event, **fields):
+        if LEVELS[level] < self.level:
+            return
+        try:
+            self._queue.put_nowait((time.time(), level, event, fields))
+        except Full:
+            self.dropped += 1
+
+    def debug(self, event, **fields):
+        self.log('debug', event, **fields)
+
+    def info(self, event, **fields):
+        self.log('info', event, **fields)
+
+    def warning(self, event, **fields):
+        self.log('warning', event, **fields)
+
+    def error(self, event, **fields):
+        self.log('error', event, **fields)
+
+    def trace(self, event, **fields):
+        # per-message debug event, sampled, one attribute check when debug is off
+        if not self.tracing:
+            return
+        if self.sample > 1 and next(self._counter) % self.sample != 0:
+            return
+        self.log('debug', event, **fields)
+
+    def close(self):
+        # write out what is queued
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            lines = [self._format(record)]
+            # format everything already waiting and write it at once
+            while not self._queue.empty() and len(lines) < 1024:
+                record = self._queue.get_nowait()
+                if record is None:
+                    self._flush(lines)
+                    return
+                lines.append(self._format(record))
+            self._flush(lines)
+
+    def _flush(self, lines):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(''.join(lines))
+        stream.flush()
+
+    @staticmethod
+    def _format(record):
+        t, level, event, fields = record
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t)) + '.{:03d}'.format(int(t % 1 * 1000))
+        pairs = ''.join(' {}={!r}'.format(k, v if isinstance(v, (str, bytes, int, float)) else str(v)) for k, v in fields.items())
+        return '{} {:<7} {}{}\n'.format(stamp, level.upper(), event, pairs)
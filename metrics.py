@@ -0,0 +1,100 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = 40
+
+
+class Histogram:
+    # power-of-two buckets of non-negative integers, recording is O(1) and lock-free,
+    # so concurrent threads may rarely lose an update
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        value = int(value)
+        self.buckets[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th value
+        rank = self.count * p
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return (1 << i) - 1
+        return 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 1) if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+        }
+
+
+class Metrics:
+    # request latencies and broadcast fan-out in microseconds, plus gauges read on demand
+    def __init__(self):
+        self.requests = {}
+        self.fanout_size = Histogram()
+        self.fanout_time = Histogram()
+        self.gauges = {}
+
+    def request(self, method, seconds):
+        histogram = self.requests.get(method)
+        if histogram is None:
+            histogram = self.requests.setdefault(method, Histogram())
+        histogram.record(seconds * 1e6)
+
+    def fanout(self, size, seconds):
+        self.fanout_size.record(size)
+        self.fanout_time.record(seconds * 1e6)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        return {
+            'requests_us': {method: h.snapshot() for method, h in sorted(self.requests.items())},
+            'fanout_size': self.fanout_size.snapshot(),
+            'fanout_us': self.fanout_time.snapshot(),
+            'gauges': {name: read() for name, read in sorted(self.gauges.items())},
+        }
+
+    def summary(self):
+        # the short form of snapshot, for frames with little room
+        return {
+            'requests': {method: h.count for method, h in sorted(self.requests.items())},
+            'fanout': self.fanout_size.count,
+            'gauges': {name: read() for name, read in sorted(self.gauges.items())},
+        }
+
+
+def serve_http(metrics, host, port):
+    # GET /stats on a local port returns the snapshot as JSON
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/stats':
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.snapshot()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
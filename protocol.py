@@ -1,51 +1,304 @@
-from config import LENGTH_SIZE
+import struct
+import zlib
+from config import HOST, LENGTH_SIZE, MAX_FRAME_SIZE, COMPRESS_THRESHOLD, COMPRESS_LEVEL
 
 VERSION = 'THTTP/1.1'
+# v2: binary frames with varint lengths, negotiated by PREFACE at the start of a connection
+VERSION_2 = 'THTTP/2'
+VERSIONS = (VERSION, VERSION_2)
+# the first byte can never start a v1 frame, whose length prefix is ascii digits
+PREFACE = b'\xffTHTTP/2\r\n'
+
+# optional header of a request, echoed by its final response so a client can keep
+# many requests in flight and match responses that come back out of order
+REQUEST_ID = 'Request-Id'
+# per-message compression, v2 only: a client offers it with Accept-Encoding on signin
+# and the server confirms it in the sign in response, after which bodies of at least
+# COMPRESS_THRESHOLD bytes may be sent zlib-compressed with Content-Encoding
+ACCEPT_ENCODING = 'Accept-Encoding'
+CONTENT_ENCODING = 'Content-Encoding'
+ZLIB = 'zlib'
+# a client that applies 208/209 member deltas says so on signin with Member-Updates:
+# delta, and the server echoes it; other clients get the full 204 list on every change
+MEMBER_UPDATES = 'Member-Updates'
+DELTA = 'delta'
+# issued with a successful sign in: after a dropped connection the server holds the
+# session for a grace period, and a resume request with the token on a new connection
+# takes it over, with the group membership and the frames queued in between
+RESUME_TOKEN = 'Resume-Token'
+
+# v2 sends the method as its index in this table, only ever append to it
+METHODS = ['signin', 'signout', 'join', 'leave', 'send', 'stats', 'ping', 'resume']
 
 
 def split_message(message):
-    p = 0
-    messages = []
-    while p < len(message):
-        length = int(message[p: p + LENGTH_SIZE])
-        p += LENGTH_SIZE
-        # print('#MESSAGE#' + message[p: p + length])
-        messages.append(message[p: p + length])
-        p += length
-    return messages
+    # split a complete chunk of frames, prefer FrameDecoder for data read from a stream
+    if isinstance(message, str):
+        message = message.encode()
+    return FrameDecoder().feed(message)
+
+
+def encode_varint(n):
+    # unsigned LEB128
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(data, p=0):
+    # return (value, next position), or (None, p) if data ends inside the varint
+    n = 0
+    shift = 0
+    while p < len(data):
+        b = data[p]
+        p += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, p
+        shift += 7
+        if shift > 63:
+            raise ValueError('Corrupted varint.')
+    return None, p
+
+
+def _utf8_end(data, p, end, count):
+    # position after count utf-8 characters from p, None if data ends inside them
+    chunk = bytes(data[p: p + count])
+    if len(chunk) == count and chunk.isascii():
+        return p + count
+    for _ in range(count):
+        if p >= end:
+            return None
+        b = data[p]
+        # the lead byte gives the width, a stray continuation byte counts as one character
+        p += 1 if b < 0xc0 else 2 if b < 0xe0 else 3 if b < 0xf0 else 4
+    return p if p <= end else None
+
+
+def _encode_string(text):
+    data = text.encode()
+    return encode_varint(len(data)) + data
+
+
+def _decode_string(data, p):
+    length, p = decode_varint(data, p)
+    if length is None or p + length > len(data):
+        raise ValueError('Corrupted string field.')
+    return str(data[p: p + length], 'utf-8', 'replace'), p + length
+
+
+class FrameDecoder:
+    # incremental per-connection decoder, frames may coalesce or split across reads
+    def __init__(self, length_size=LENGTH_SIZE, version=VERSION, negotiate=False):
+        self._length_size = length_size
+        self._buffer = bytearray()
+        # v1 frames decode to str, v2 frames to bytes payloads
+        self.version = version
+        # server side: a connection may open with PREFACE to switch to v2
+        self._negotiate = negotiate
+
+    def __len__(self):
+        # bytes of the pending partial frame
+        return len(self._buffer)
+
+    def feed(self, data):
+        # append the bytes just read and return every complete message decoded so far
+        self._buffer += data
+        if self._negotiate:
+            if len(self._buffer) == 0:
+                return []
+            if self._buffer[0] == PREFACE[0]:
+                if len(self._buffer) < len(PREFACE):
+                    return []
+                if self._buffer[: len(PREFACE)] != PREFACE:
+                    raise ValueError('Corrupted preface.')
+                del self._buffer[: len(PREFACE)]
+                self.version = VERSION_2
+            self._negotiate = False
+        if self.version == VERSION_2:
+            return self._feed_v2()
+        return self._feed_v1()
+
+    def _feed_v1(self):
+        messages = []
+        p = 0
+        end = len(self._buffer)
+        with memoryview(self._buffer) as view:
+            while end - p >= self._length_size:
+                prefix = bytes(view[p: p + self._length_size])
+                if not prefix.isdigit():
+                    raise ValueError('Corrupted frame length {!r}.'.format(prefix))
+                # the length counts characters, as THTTP/1.1 clients always have
+                start = p + self._length_size
+                stop = _utf8_end(view, start, end, int(prefix))
+                if stop is None:
+                    break
+                messages.append(str(view[start: stop], 'utf-8', 'replace'))
+                p = stop
+        # consumed frames are dropped from the front, the buffer itself is kept
+        del self._buffer[:p]
+        return messages
+
+    def _feed_v2(self):
+        messages = []
+        p = 0
+        end = len(self._buffer)
+        with memoryview(self._buffer) as view:
+            while p < end:
+                length, start = decode_varint(view, p)
+                if length is None:
+                    break
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError('Frame of {} bytes is too large.'.format(length))
+                if end - start < length:
+                    break
+                messages.append(bytes(view[start: start + length]))
+                p = start + length
+        del self._buffer[:p]
+        return messages
 
 
 # THTTP: trivial hypertext transfer protocol
 class _THTTP:
-    def __init__(self, start_line, headers=[], body="", message=None):
-        self._new_line = "\r\n"
-
-        self._length_size = LENGTH_SIZE
-        self.start_line = start_line
-        self.headers = headers
-        self.empty_line = self._new_line
-        self.body = body
+    _new_line = "\r\n"
+    empty_line = "\r\n"
+    _length_size = LENGTH_SIZE
 
+    def __init__(self, start_line, headers=[], body="", message=None, version=VERSION):
+        # wire bytes per (version, compress), filled by encode
+        self._frames = None
+        self._raw_headers = None
         if message is not None:
-            self._parse(message)
+            if version == VERSION_2:
+                self._parse_v2(message)
+            else:
+                self._parse(message)
+        else:
+            self.start_line = start_line
+            self._headers = headers
+            self.body = body
+
+    @property
+    def headers(self):
+        # v1 header lines are split on first use
+        if self._raw_headers is not None:
+            raw = self._raw_headers
+            self._raw_headers = None
+            self._headers = [] if raw == '' else [tuple(header.split(': ', 1)) for header in raw.split('\r\n')]
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._raw_headers = None
+        self._headers = headers
 
     def _parse(self, message):
-        split = message.split('\r\n')
-        self.start_line = split[0].split(' ', 2)
-        self.headers = [tuple(header.split(': ', 1)) for header in split[1:-2]]
-        self.body = split[-1].strip()
+        end = message.find('\r\n')
+        line = message if end < 0 else message[:end]
+        start_line = self._start_lines.get(line)
+        self.start_line = line.split(' ', 2) if start_line is None else start_line
+        self._headers = []
+        separator = -1 if end < 0 else message.find('\r\n\r\n', end)
+        if separator < 0:
+            # no empty line, the body is whatever follows the last line break
+            self.body = message[message.rfind('\r\n') + 2:].strip() if end >= 0 else message.strip()
+        else:
+            self._raw_headers = message[end + 2: separator]
+            self.body = message[separator + 4:].strip()
+
+    def _parse_v2(self, payload):
+        p = self._parse_start_line_v2(payload)
+        count, p = decode_varint(payload, p)
+        if count is None:
+            raise ValueError('Corrupted header count.')
+        headers = []
+        for _ in range(count):
+            name, p = _decode_string(payload, p)
+            value, p = _decode_string(payload, p)
+            headers.append((name, value))
+        body = payload[p:]
+        if (CONTENT_ENCODING, ZLIB) in headers:
+            headers.remove((CONTENT_ENCODING, ZLIB))
+            decompressor = zlib.decompressobj()
+            body = decompressor.decompress(body, MAX_FRAME_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ValueError('Compressed body is too large.')
+        self._headers = headers
+        self.body = str(body, 'utf-8', 'replace')
 
     def __repr__(self):
         # get the str representation of the message
-        start_line = ' '.join(self.start_line) + self._new_line
-        headers = "" if len(self.headers) == 0 else self._new_line.join([': '.join([t, v]) for (t, v) in self.headers]) + self._new_line
-        text = start_line + headers + self.empty_line + self.body
-        text = text[: min(len(text), 10 ** self._length_size - 1)]
-        length = str(len(text)).zfill(self._length_size)
-        return length + text
+        return self.encode(VERSION).decode()
+
+    def _start_line_text(self):
+        return ' '.join(self.start_line) + self._new_line
+
+    def _text(self):
+        headers = self.headers
+        headers = "" if len(headers) == 0 else self._new_line.join([': '.join([t, v]) for (t, v) in headers]) + self._new_line
+        return self._start_line_text() + headers + self.empty_line + self.body
+
+    def encode(self, version=VERSION, compress=False):
+        # get the wire bytes of the message for a connection speaking version,
+        # cached since a message is not changed once it is sent
+        compress = compress and version == VERSION_2
+        if self._frames is None:
+            self._frames = {}
+        frame = self._frames.get((version, compress))
+        if frame is None:
+            if version == VERSION_2:
+                payload = self._encode_v2(compress)
+                frame = encode_varint(len(payload)) + payload
+            else:
+                # the v1 length prefix counts characters, not utf-8 bytes
+                text = self._text()[: 10 ** self._length_size - 1]
+                frame = str(len(text)).zfill(self._length_size).encode() + text.encode()
+            self._frames[(version, compress)] = frame
+        return frame
+
+    def fits(self, version=VERSION):
+        # False when encode would have to cut the v1 text
+        return version == VERSION_2 or len(self._text()) <= 10 ** self._length_size - 1
+
+    def _encode_v2(self, compress=False):
+        headers = self.headers
+        body = self.body.encode()
+        if compress and len(body) >= COMPRESS_THRESHOLD:
+            compressed = zlib.compress(body, COMPRESS_LEVEL)
+            if len(compressed) < len(body):
+                headers = headers + [(CONTENT_ENCODING, ZLIB)]
+                body = compressed
+        if len(headers) == 0:
+            return self._start_line_v2() + b'\x00' + body
+        parts = [self._start_line_v2(), encode_varint(len(headers))]
+        for (t, v) in headers:
+            parts.append(_encode_string(t))
+            parts.append(_encode_string(v))
+        parts.append(body)
+        return b''.join(parts)
+
+    def with_header(self, name, value):
+        # a copy with one more header, shared constant messages are never changed
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.headers = self.headers + [(name, value)]
+        other._frames = None
+        return other
+
+    def get_header(self, name):
+        # most frames carry no such header, skip splitting the raw header lines then
+        if self._raw_headers is not None and name not in self._raw_headers:
+            return None
+        for header in self.headers:
+            if len(header) == 2 and header[0] == name:
+                return header[1]
+        return None
 
     def _check_headers(self):
-        if len(self.headers) == 0:
+        if self._raw_headers == '':
             return True
         for t in self.headers:
             if len(t) != 2:
@@ -54,21 +307,41 @@ class _THTTP:
 
 
 class THTTP_Request(_THTTP):
-    def __init__(self, method="", target="/", headers=[], body="", message=None):
-        super().__init__([method.lower(), target, VERSION], headers=headers, body=body, message=message)
-        self._methods = ['signin', 'signout', 'join', 'leave', 'send']
+    _methods = METHODS
+    _method_index = {method: i for i, method in enumerate(METHODS)}
+    # parsed v1 start lines shared by their text, every method to the targets the clients use
+    _start_lines = {' '.join(line): line for line in
+                    ((method, target, VERSION) for method in METHODS for target in ('/', HOST))}
+
+    def __init__(self, method="", target="/", headers=[], body="", message=None, version=VERSION):
+        if message is None:
+            super().__init__([method.lower(), target, VERSION], headers=headers, body=body)
+        else:
+            super().__init__(None, message=message, version=version)
         # GET: get stuff from target url
 
     def __str__(self):
         return "{} {}: {}".format(self.start_line[0], self.start_line[1], self.body.strip())
 
+    def _start_line_v2(self):
+        # u8 method index, then the target
+        return bytes([self._method_index.get(self.start_line[0], 0xff)]) + _encode_string(self.start_line[1])
+
+    def _parse_start_line_v2(self, payload):
+        if len(payload) == 0:
+            raise ValueError('Empty request.')
+        method = METHODS[payload[0]] if payload[0] < len(METHODS) else ''
+        target, p = _decode_string(payload, 1)
+        self.start_line = [method, target, VERSION_2]
+        return p
+
     def get_method(self):
         return self.start_line[0]
 
     def check(self):
-        if self.start_line[0] not in self._methods:
+        if self.start_line[0] not in self._method_index:
             return False
-        if self.start_line[2] != VERSION:
+        if len(self.start_line) != 3 or self.start_line[2] not in VERSIONS:
             return False
         if self._check_headers() is False:
             return False
@@ -76,34 +349,79 @@ class THTTP_Request(_THTTP):
 
 
 class THTTP_Response(_THTTP):
-    def __init__(self, status_code='400', headers=[], body="", message=None):
-        self._status = {
-            '200': 'Sign in success',
-            '201': 'Sign out success',
-            '202': 'Join group success',
-            '203': 'Leave group success',
-            '204': 'Group members',
-            '205': 'Send chat success',
-            '300': 'Sign in error',
-            '301': 'Sign out error',
-            '302': 'Join group error',
-            '303': 'Leave group error',
-            '305': 'Send chat error',
-            '400': 'Wrong format request',
-        }
-        if status_code not in self._status:
-            status_code = '400'
-        super().__init__([VERSION, status_code, self._status[status_code]], headers=headers, body=body, message=message)
+    _status = {
+        '200': 'Sign in success',
+        '201': 'Sign out success',
+        '202': 'Join group success',
+        '203': 'Leave group success',
+        '204': 'Group members',
+        '205': 'Send chat success',
+        '206': 'Server stats',
+        '207': 'Pong',
+        '208': 'Members joined',
+        '209': 'Members left',
+        '210': 'Resume success',
+        '300': 'Sign in error',
+        '301': 'Sign out error',
+        '302': 'Join group error',
+        '303': 'Leave group error',
+        '305': 'Send chat error',
+        '306': 'Resume error',
+        '400': 'Wrong format request',
+        '401': 'Too many requests',
+        '402': 'Server busy',
+    }
+    # one shared start line per status code and version, with its v1 text and v2 bytes
+    _start_lines_by_code = {code: (VERSION, code, reason) for code, reason in _status.items()}
+    _start_lines_v2 = {code: (VERSION_2, code, reason) for code, reason in _status.items()}
+    _start_lines = {' '.join(line): line for line in _start_lines_by_code.values()}
+    _start_line_texts = {line: ' '.join(line) + '\r\n' for line in _start_lines_by_code.values()}
+    _codes_v2 = {code: struct.pack('>H', int(code)) for code in _status}
+
+    def __init__(self, status_code='400', headers=[], body="", message=None, version=VERSION):
+        if message is None:
+            start_line = self._start_lines_by_code.get(status_code)
+            if start_line is None:
+                start_line = self._start_lines_by_code['400']
+            super().__init__(start_line, headers=headers, body=body)
+        else:
+            super().__init__(None, message=message, version=version)
+
+    @classmethod
+    def constant(cls, status_code, body=''):
+        # a response sent many times, encoded once up front for every wire format
+        response = cls(status_code=status_code, body=body)
+        for version in VERSIONS:
+            response.encode(version)
+            response.encode(version, True)
+        return response
 
     def __str__(self):
         # display on the chat window, easy to read
         return "{} {}: {}".format(self.start_line[1], self.start_line[2], self.body)
 
+    def _start_line_text(self):
+        text = self._start_line_texts.get(tuple(self.start_line))
+        return super()._start_line_text() if text is None else text
+
+    def _start_line_v2(self):
+        # u16 status code, the reason phrase is implied
+        code = self._codes_v2.get(self.start_line[1])
+        return struct.pack('>H', int(self.start_line[1])) if code is None else code
+
+    def _parse_start_line_v2(self, payload):
+        if len(payload) < 2:
+            raise ValueError('Empty response.')
+        status_code = str(struct.unpack_from('>H', payload)[0])
+        start_line = self._start_lines_v2.get(status_code)
+        self.start_line = (VERSION_2, status_code, '') if start_line is None else start_line
+        return 2
+
     def get_status_code(self):
         return self.start_line[1]
 
     def check(self):
-        if self.start_line[0] != VERSION:
+        if len(self.start_line) != 3 or self.start_line[0] not in VERSIONS:
             return False
         if self.start_line[1] not in self._status:
             return False
@@ -112,3 +430,8 @@ class THTTP_Response(_THTTP):
         # if self._check_headers() is False:
         #     return False
         return True
+
+
+# constant responses, reply adds a Request-Id to a copy
+CORRUPTED_REQUEST = THTTP_Response.constant('400', 'Corrupted request!')
+EMPTY_MEMBERS = THTTP_Response.constant('204')
@@ -0,0 +1,78 @@
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class Reactor:
+    # one thread waits on every registered socket through the platform's best selector
+    # (epoll on Linux) and runs the callbacks of the ready ones. Each pass then runs the
+    # timers that are due and the callbacks queued so far, the ones they queue wait for
+    # the next pass. Other threads hand it work through call_soon_threadsafe
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()
+        # heap of (when, sequence, func, args)
+        self.timers = []
+        self._sequence = itertools.count()
+        # a byte on this pair wakes up select for callbacks of other threads
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._drain)
+
+    def register(self, sock, events, callback):
+        # callback(sock, mask) runs when sock is ready for events
+        self.selector.register(sock, events, callback)
+
+    def modify(self, sock, events, callback):
+        self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    def call_soon(self, func, *args):
+        self.ready.append((func, args))
+
+    def call_soon_threadsafe(self, func, *args):
+        self.ready.append((func, args))
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # the pipe is full, select is woken up anyway
+            pass
+
+    def call_later(self, delay, func, *args):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self._sequence), func, args))
+
+    def every(self, interval, func):
+        def tick():
+            self.call_later(interval, tick)
+            func()
+        self.call_later(interval, tick)
+
+    def _drain(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            timeout = None
+            if len(self.ready) > 0:
+                timeout = 0
+            elif len(self.timers) > 0:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                key.data(key.fileobj, mask)
+            now = time.monotonic()
+            while len(self.timers) > 0 and self.timers[0][0] <= now:
+                _, _, func, args = heapq.heappop(self.timers)
+                func(*args)
+            for _ in range(len(self.ready)):
+                func, args = self.ready.popleft()
+                func(*args)
@@ -1,8 +1,34 @@
-from protocol import THTTP_Request, THTTP_Response, split_message
+from protocol import THTTP_Request, THTTP_Response, FrameDecoder, VERSION, VERSION_2, PREFACE, REQUEST_ID, \
+    ACCEPT_ENCODING, ZLIB, MEMBER_UPDATES, DELTA, RESUME_TOKEN, CORRUPTED_REQUEST, EMPTY_MEMBERS
+from chatlog import ChatLog, read_records
+from metrics import Metrics, serve_http
+from logger import Logger, LEVELS
+from timerwheel import TimerWheel
+from reactor import Reactor
+from bus import Hub, Bus
+from federation import Federation, is_loopback, parse_address
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import secrets
+import selectors
+import signal
 import socket
+import tempfile
 import threading
+import time
 from queue import Queue
-from config import HOST, PORT, MAX_THREAD, BUFSIZE, LENGTH_SIZE
+from collections import deque, OrderedDict
+from config import HOST, PORT, MAX_THREAD, BUFSIZE, ENGINE, ASYNC_BACKLOG, ACCEPT_BATCH, OUTBOUND_QUEUE_SIZE, LOCK_STRIPES, \
+    OUTBOUND_HIGH_WATER, OUTBOUND_POLICY, MAX_CHAT_LENGTH, RATE_LIMITS, IDLE_TIMEOUT, REAPER_TICK, MEMBER_DEBOUNCE, \
+    WRITE_DELAY, WRITE_BATCH_BYTES, WRITE_BATCH_FRAMES, TCP_NODELAY, \
+    KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_COUNT, HISTORY_SIZE, HISTORY_BYTES, IDLE_GROUPS, LOG_DIR, STATS_PORT, \
+    LOG_LEVEL, LOG_SAMPLE, REQUEST_THREAD, WORKERS, \
+    CLUSTER, PEERS, CLUSTER_KEY, MIN_THREAD, THREAD_IDLE_TIMEOUT, THREAD_STACK_SIZE, CONNECTION_QUEUE_SIZE, \
+    RESUME_GRACE
 
 
 class ThreadManger(threading.Thread):
@@ -33,95 +59,350 @@ class ThreadPoolManger:
         self.work_queue.put((func, args))
 
 
-class ChatRoom:
+class ElasticThreadPool:
+    # threads are started on demand up to max_threads, and the ones above min_threads
+    # exit after idle_timeout seconds without work; once every thread is busy at most
+    # queue_size jobs wait, submit refuses the rest
+    def __init__(self, min_threads, max_threads, idle_timeout=THREAD_IDLE_TIMEOUT, queue_size=CONNECTION_QUEUE_SIZE):
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.idle_timeout = idle_timeout
+        self.queue_size = queue_size
+        self.jobs = deque()
+        self.threads = 0
+        # threads running a job, the others are idle or about to take one
+        self.busy = 0
+        self.refused = 0
+        self.ready = threading.Condition()
+
+    def submit(self, func, *args):
+        with self.ready:
+            if len(self.jobs) >= self.max_threads - self.busy + self.queue_size:
+                self.refused += 1
+                return False
+            self.jobs.append((func, args))
+            if len(self.jobs) > self.threads - self.busy and self.threads < self.max_threads:
+                self.threads += 1
+                threading.Thread(target=self._work, daemon=True).start()
+            else:
+                self.ready.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self.ready:
+                while len(self.jobs) == 0:
+                    woken = self.ready.wait(self.idle_timeout if self.threads > self.min_threads else None)
+                    if not woken and len(self.jobs) == 0 and self.threads > self.min_threads:
+                        self.threads -= 1
+                        return
+                func, args = self.jobs.popleft()
+                self.busy += 1
+            try:
+                func(*args)
+            finally:
+                with self.ready:
+                    self.busy -= 1
+
+
+class Session:
+    # per-connection chat state, empty strings mean not signed in / not in a group / no resume
+    __slots__ = ('username', 'group', 'token')
+
     def __init__(self):
+        self.username = ''
+        self.group = ''
+        self.token = ''
+
+
+class Group:
+    # members plus the recent chat history replayed to whoever joins
+    __slots__ = ('members', 'history', 'history_bytes', 'changes')
+
+    def __init__(self):
+        self.members = set()
+        self.history = deque()
+        self.history_bytes = 0
+        # username -> joined (True) or left (False) since the last member update
+        self.changes = {}
+
+
+class ChatRoom:
+    # sessions, the username index and the group member sets are guarded by striped
+    # locks, a session lock is always taken before a user or group lock
+    def __init__(self, lock_stripes=LOCK_STRIPES, max_history=HISTORY_SIZE, max_history_bytes=HISTORY_BYTES,
+                 max_idle_groups=IDLE_GROUPS):
         self.connection = {}
+        self.user = {}
         self.group = {}
+        self.max_history = max_history
+        self.max_history_bytes = max_history_bytes
+        # groups without members, kept for their history, least recently used first
+        self.idle = OrderedDict()
+        self.max_idle_groups = max_idle_groups
+        self._session_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._user_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._group_locks = [threading.Lock() for _ in range(lock_stripes)]
+        # taken inside a group lock, never the other way round
+        self._idle_lock = threading.Lock()
+
+    def _session_lock(self, connect):
+        return self._session_locks[hash(connect) % len(self._session_locks)]
+
+    def _user_lock(self, username):
+        return self._user_locks[hash(username) % len(self._user_locks)]
+
+    def _group_lock(self, group):
+        return self._group_locks[hash(group) % len(self._group_locks)]
+
+    def single_threaded(self):
+        # for an engine that makes every call from one thread, the locks become no-ops
+        self._session_locks = self._user_locks = self._group_locks = [contextlib.nullcontext()]
+        self._idle_lock = contextlib.nullcontext()
 
     def connect(self, connect):
-        self.connection[connect] = {'username': '', 'group': ''}
+        self.connection[connect] = Session()
 
-    def sign_in(self, connect, username):
+    def disconnect(self, connect):
+        with self._session_lock(connect):
+            session = self.connection.pop(connect, None)
+            if session is not None and session.username != '':
+                with self._user_lock(session.username):
+                    if self.user.get(session.username) is connect:
+                        del self.user[session.username]
+
+    def sign_in(self, connect, username, token=''):
+        with self._session_lock(connect):
+            return self._sign_in(connect, username, token)
+
+    def _sign_in(self, connect, username, token):
+        session = self.connection.get(connect)
         # connection not exist
-        if connect not in self.connection:
+        if session is None:
             return False, 'Connection not exist.'
         # already sign in
-        if self.connection[connect]['username'] != '':
+        if session.username != '':
             return False, 'Already signed in.'
-        # username collision
-        for c in self.connection:
-            if self.connection[c]['username'] == username:
+        with self._user_lock(username):
+            # username collision
+            if username in self.user:
                 return False, 'Username collision.'
-        self.connection[connect]['username'] = username
+            self.user[username] = connect
+        session.username = username
+        session.token = token
         return True, 'Sign in as {}.'.format(username)
 
     def sign_out(self, connect):
+        with self._session_lock(connect):
+            return self._sign_out(connect)
+
+    def _sign_out(self, connect):
+        session = self.connection.get(connect)
         # connection not exist
-        if connect not in self.connection:
+        if session is None:
             return False, 'Connection not exist.'
         # not sign in
-        if self.connection[connect]['username'] == '':
+        if session.username == '':
             return False, 'Not signed in.'
         # already in a group
-        if self.connection[connect]['group'] != '':
+        if session.group != '':
             return False, 'Leave group first.'
-        self.connection[connect]['username'] = ''
+        with self._user_lock(session.username):
+            del self.user[session.username]
+        session.username = ''
+        session.token = ''
         return True, 'Sign out successful.'
 
-    def join(self, connect, group):
+    def join(self, connect, group, welcome=None):
+        # welcome(description, history, members) runs under the group lock once connect is
+        # a member, so whatever it sends comes before any chat delivered to the group later
+        with self._session_lock(connect):
+            return self._join(connect, group, welcome)
+
+    def _join(self, connect, group, welcome):
+        session = self.connection.get(connect)
         # connection not exist
-        if connect not in self.connection:
+        if session is None:
             return False, 'Connection not exist.'
         # not sign in
-        if self.connection[connect]['username'] == '':
+        if session.username == '':
             return False, 'Not signed in.'
         # already in a group
-        if self.connection[connect]['group'] != '':
+        if session.group != '':
             return False, 'Already in a group.'
-        self.connection[connect]['group'] = group
-        if group not in self.group:
-            self.group[group] = set()
-        self.group[group].add(connect)
-        return True, 'Join group {}.'.format(group)
+        with self._group_lock(group):
+            if group not in self.group:
+                self.group[group] = Group()
+            record = self.group[group]
+            record.members.add(connect)
+            record.changes[session.username] = True
+            self._set_idle(group, False)
+            session.group = group
+            description = 'Join group {}.'.format(group)
+            if welcome is not None:
+                welcome(description, [response for response, _ in record.history], tuple(record.members))
+        return True, description
 
     def leave(self, connect):
+        with self._session_lock(connect):
+            return self._leave(connect)
+
+    def _leave(self, connect):
+        session = self.connection.get(connect)
         # connection not exist
-        if connect not in self.connection:
+        if session is None:
             return False, 'Connection not exist.'
-        group = self.connection[connect]['group']
+        group = session.group
         # not sign in
-        if self.connection[connect]['username'] == '':
+        if session.username == '':
             return False, 'Not signed in.'
         # not in a group
-        if self.connection[connect]['group'] == '':
+        if group == '':
             return False, 'Not in a group.'
-        self.group[group].remove(connect)
-        if len(self.group[group]) == 0:
-            del self.group[group]
-        self.connection[connect]['group'] = ''
+        with self._group_lock(group):
+            record = self.group[group]
+            record.members.remove(connect)
+            record.changes[session.username] = False
+            # an empty group is kept while it has history to replay, up to max_idle_groups
+            if len(record.members) == 0:
+                if len(record.history) == 0:
+                    del self.group[group]
+                else:
+                    self._set_idle(group, True)
+        session.group = ''
+        self._trim_idle()
         return True, 'Leave group successful.'
 
+    def transfer(self, old, new):
+        # new takes over the signed in session of old, its username and group membership,
+        # without a member change; False when old is not signed in
+        with self._session_lock(old):
+            session = self.connection.get(old)
+            if session is None or session.username == '':
+                return False
+            del self.connection[old]
+        with self._user_lock(session.username):
+            if self.user.get(session.username) is old:
+                self.user[session.username] = new
+        if session.group != '':
+            with self._group_lock(session.group):
+                members = self.group[session.group].members
+                members.discard(old)
+                members.add(new)
+        with self._session_lock(new):
+            self.connection[new] = session
+        return True
+
     def send(self, connect):
+        session = self.connection.get(connect)
         # connection not exist
-        if connect not in self.connection:
+        if session is None:
             return False, 'Connection not exist.'
         # not sign in
-        if self.connection[connect]['username'] == '':
+        if session.username == '':
             return False, 'Not signed in.'
         # not in a group
-        if self.connection[connect]['group'] == '':
+        if session.group == '':
             return False, 'Not in a group.'
         # send message doesn't need to be shown on chat window
         return True, ''
 
     def member_of(self, connect):
-        group = self.connection[connect]['group']
-        if group not in self.group:
-            return set()
-        return self.group[group]
+        return self.members(self.group_of(connect))
+
+    def group_of(self, connect):
+        session = self.connection.get(connect)
+        if session is None:
+            return ''
+        return session.group
+
+    def members(self, group):
+        # snapshot, safe to iterate while other threads join and leave
+        with self._group_lock(group):
+            record = self.group.get(group)
+            return () if record is None else tuple(record.members)
+
+    def note_change(self, group, username, joined):
+        # a member of another worker process joined or left, False if no member here cares
+        with self._group_lock(group):
+            record = self.group.get(group)
+            if record is None or len(record.members) == 0:
+                return False
+            record.changes[username] = joined
+        return True
+
+    def take_changes(self, group):
+        # joined and left usernames since the last call, only the latest change of each user counts
+        with self._group_lock(group):
+            record = self.group.get(group)
+            if record is None:
+                return [], []
+            changes = record.changes
+            record.changes = {}
+        joined = [username for username, is_join in changes.items() if is_join]
+        left = [username for username, is_join in changes.items() if not is_join]
+        return joined, left
+
+    def record(self, group, response):
+        # keep the chat response for replay and return the members to deliver it to, taken
+        # together so a member joining meanwhile gets it either replayed or live, not both
+        size = len(response.encode(VERSION_2))
+        with self._group_lock(group):
+            if group not in self.group:
+                self.group[group] = Group()
+            record = self.group[group]
+            record.history.append((response, size))
+            record.history_bytes += size
+            while len(record.history) > self.max_history or record.history_bytes > self.max_history_bytes:
+                _, evicted = record.history.popleft()
+                record.history_bytes -= evicted
+            members = tuple(record.members)
+            if len(members) == 0:
+                self._set_idle(group, True)
+        if len(members) == 0:
+            self._trim_idle()
+        return members
+
+    def _set_idle(self, group, idle):
+        # under the group lock
+        with self._idle_lock:
+            if idle:
+                self.idle[group] = None
+                self.idle.move_to_end(group)
+            else:
+                self.idle.pop(group, None)
+
+    def _trim_idle(self):
+        # forget the least recently used empty groups and their history, outside any group lock
+        while len(self.idle) > self.max_idle_groups:
+            with self._idle_lock:
+                if len(self.idle) <= self.max_idle_groups:
+                    return
+                group, _ = self.idle.popitem(last=False)
+            with self._group_lock(group):
+                record = self.group.get(group)
+                if record is not None and len(record.members) == 0:
+                    del self.group[group]
+
+    def history(self, group):
+        with self._group_lock(group):
+            record = self.group.get(group)
+            return [] if record is None else [response for response, _ in record.history]
+
+    def connection_of(self, username):
+        return self.user.get(username)
 
     def username_of(self, connect):
-        return self.connection[connect]['username']
+        session = self.connection.get(connect)
+        if session is None:
+            return ''
+        return session.username
+
+    def token_of(self, connect):
+        session = self.connection.get(connect)
+        if session is None:
+            return ''
+        return session.token
 
     def member_text(self, connect, other=None):
         members = []
@@ -131,127 +412,1261 @@ class ChatRoom:
         return ','.join(members)
 
 
-def handle_request(connect):
-    global chat
+class TokenBucket:
+    # refills rate tokens per second up to burst
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
 
-    def send(message):
-        connect.sendall(message.encode())
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
 
-    def broadcast(message, other=None):
-        for c in chat.member_of(connect):
-            if c != other:
-                # print('#Send to ' + str(c) + chat.username_of(c))
-                c.sendall(message.encode())
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
 
-    while True:
+
+class Connection:
+    # peer handle keyed in ChatRoom, remembers the protocol version it negotiated, limits
+    # its request rate and holds its outbound frames up to the high-water marks
+    def __init__(self, policy=OUTBOUND_POLICY):
+        self.version = VERSION
+        # zlib for large bodies and 208/209 member deltas, negotiated at sign in
+        self.compress = False
+        self.deltas = False
+        self.closed = False
+        # monotonic time of the last bytes read, for the idle reaper once heartbeat is set
+        self.last_active = time.monotonic()
+        self.heartbeat = False
+        # requests that came while its sign in waits for a claim on the loop engines
+        self.pending = None
+        # frames refused since the connection opened, a held session with any cannot resume
+        self.dropped = 0
+        self.policy = policy
+        self.buckets = {}
+        # (frame, is chat) pairs waiting for the writer
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        # the part of the last batch the socket did not take, written before the queue
+        self.unsent = []
+
+    def upgrade(self, version):
+        self.version = version
+        self.sendall(PREFACE)
+
+    def send(self, response):
+        self.sendall(response.encode(self.version, self.compress))
+
+    def allow(self, method):
+        # token bucket per method, created on first use
+        bucket = self.buckets.get(method)
+        if bucket is None:
+            if method not in RATE_LIMITS:
+                return True
+            bucket = self.buckets[method] = TokenBucket(*RATE_LIMITS[method])
+        return bucket.take()
+
+    def _push(self, data, chat, bounded=True):
+        # queue a frame, applying the drop policy once the peer stops reading; unbounded
+        # frames were within the marks of a held session and are always queued. Every
+        # frame refused counts as dropped, also the ones for an evicted or closed connection
+        if self.closed:
+            self.dropped += 1
+            return False
+        if bounded and len(data) > OUTBOUND_HIGH_WATER:
+            # too large even for an empty queue, the queued frames and the peer are not to blame
+            self.dropped += 1
+            return False
+        while bounded and (len(self.outbound) >= OUTBOUND_QUEUE_SIZE or
+                           self.outbound_bytes + len(data) > OUTBOUND_HIGH_WATER):
+            if self.policy == 'disconnect':
+                self.dropped += 1
+                self.evict()
+                return False
+            if self.policy != 'drop-oldest' or not self._drop_oldest_chat():
+                self.dropped += 1
+                return False
+        self.outbound.append((data, chat))
+        self.outbound_bytes += len(data)
+        return True
+
+    def _drop_oldest_chat(self):
+        for i, (data, chat) in enumerate(self.outbound):
+            if chat is True:
+                del self.outbound[i]
+                self.outbound_bytes -= len(data)
+                self.dropped += 1
+                return True
+        return False
+
+    def _pop(self):
+        data, _ = self.outbound.popleft()
+        self.outbound_bytes -= len(data)
+        return data
+
+    def take_outbound(self):
+        # the frames the writer has not finished, for the session holder: those of the last
+        # batch the socket did not take whole, the peer lost the part of one it got with the
+        # connection, then the ones it has not started on. Frames sent here afterwards count
+        # as dropped
+        self.closed = True
+        frames, self.outbound = self.outbound, deque()
+        self.outbound_bytes = 0
+        for data in reversed(self.unsent):
+            frames.appendleft((bytes(data.obj) if isinstance(data, memoryview) else data, False))
+        self.unsent = []
+        return frames
+
+    def _pop_batch(self):
+        # queued frames for one write, at least one and at most WRITE_BATCH_BYTES or WRITE_BATCH_FRAMES
+        batch = [self._pop()]
+        size = len(batch[0])
+        while len(self.outbound) > 0 and len(batch) < WRITE_BATCH_FRAMES:
+            size += len(self.outbound[0][0])
+            if size > WRITE_BATCH_BYTES:
+                break
+            batch.append(self._pop())
+        return batch
+
+
+class SocketConnection(Connection):
+    # frames go to a bounded outbound queue drained by a dedicated writer thread
+    def __init__(self, sock, peer=None):
+        super().__init__()
+        self.sock = sock
+        self.peer = peer
+        self.ready = threading.Condition()
+        # set while the writer sends self.unsent outside the lock
+        self.sending = False
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def __repr__(self):
+        return '<SocketConnection peer={}>'.format(self.peer)
+
+    def sendall(self, data, chat=False, bounded=True):
+        # never blocks, chat frames may be dropped for a peer that is not reading
+        with self.ready:
+            if self._push(data, chat, bounded):
+                self.ready.notify()
+
+    def _write(self):
+        while True:
+            with self.ready:
+                while len(self.outbound) == 0 and not self.closed:
+                    self.ready.wait()
+                # with a write delay, let frames gather up to the byte budget
+                deadline = time.monotonic() + write_delay
+                while write_delay > 0 and self.outbound_bytes < WRITE_BATCH_BYTES and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.ready.wait(remaining)
+                if self.closed:
+                    break
+                self.unsent = self._pop_batch()
+                self.sending = True
+            try:
+                self._send_batch()
+                failed = False
+            except OSError:
+                failed = True
+            with self.ready:
+                # on failure self.unsent keeps what the socket did not take, for a resume
+                if not failed:
+                    self.unsent = []
+                self.sending = False
+                self.ready.notify_all()
+            if failed:
+                # wake up the reader, it runs the disconnect cleanup
+                self.evict()
+                break
+
+    def _send_batch(self):
+        # every frame of self.unsent in one scatter-gather syscall when the platform has sendmsg
+        batch = self.unsent
+        if len(batch) == 1 or not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(batch))
+            return
+        while True:
+            sent = self.sock.sendmsg(batch)
+            i = 0
+            while i < len(batch) and sent >= len(batch[i]):
+                sent -= len(batch[i])
+                i += 1
+            if i == len(batch):
+                return
+            # a short write, continue from the unsent part
+            batch = self.unsent = [memoryview(batch[i])[sent:]] + batch[i + 1:]
+
+    def evict(self):
+        # stop writing and make the reader fail, it runs the disconnect cleanup
+        self.closed = True
         try:
-            message = connect.recv(BUFSIZE).decode()
-            # print("thread {} is running".format(threading.current_thread().name))
-            print('{} sent: {}'.format(threading.current_thread().name, message))
-            # for request_message in split_message(message):
-            #     request = THTTP_Request(message=request_message)
-            request = THTTP_Request(message=message[LENGTH_SIZE:])
-            if request.check() is False:
-                response = THTTP_Response(status_code='400', body='Corrupted request!')
-                # print(repr(response))
-                send(repr(response))
-            elif request.get_method() == 'signin':
-                username = request.body
-                success, description = chat.sign_in(connect, username)
-                if success is True:
-                    response = THTTP_Response(status_code='200', body=description)
-                else:
-                    response = THTTP_Response(status_code='300', body=description)
-                # print(str(response))
-                send(repr(response))
-            elif request.get_method() == 'signout':
-                success, description = chat.sign_out(connect)
-                if success is True:
-                    response = THTTP_Response(status_code='201', body=description)
-                else:
-                    response = THTTP_Response(status_code='301', body=description)
-                send(repr(response))
-            elif request.get_method() == 'join':
-                group = request.body
-                success, description = chat.join(connect, group)
-                if success is True:
-                    response = THTTP_Response(status_code='202', body=description)
-                    member_response = THTTP_Response(status_code='204', body=chat.member_text(connect))
-                    # print(str(member_response))
-                    broadcast(repr(member_response))
-                else:
-                    response = THTTP_Response(status_code='302', body=description)
-                # print(str(response))
-                send(repr(response))
-            elif request.get_method() == 'leave':
-                member_text = chat.member_text(connect, other=connect)
-                members = chat.member_of(connect)
-                success, description = chat.leave(connect)
-                if success is True:
-                    response = THTTP_Response(status_code='203', body=description)
-                    # update the members' list in other members
-                    member_response = THTTP_Response(status_code='204', body=member_text)
-                    for c in members:
-                        if c != connect:
-                            c.sendall(repr(member_response).encode())
-                    empty_member_response = THTTP_Response(status_code='204')
-                    send(repr(empty_member_response))
-                else:
-                    response = THTTP_Response(status_code='303', body=description)
-                send(repr(response))
-            elif request.get_method() == 'send':
-                success, description = chat.send(connect)
-                if success is True:
-                    text = "{}: {}".format(chat.username_of(connect), request.body)
-                    response = THTTP_Response(status_code='205', body=text)
-                    broadcast(repr(response))
-                else:
-                    response = THTTP_Response(status_code='305', body=description)
-                    send(repr(response))
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def take_outbound(self):
+        # stop the writer first, a batch it has in flight fails and stays in self.unsent
+        with self.ready:
+            self.evict()
+            self.ready.notify_all()
+            while self.sending:
+                self.ready.wait()
+            return super().take_outbound()
+
+    def close(self):
+        with self.ready:
+            self.evict()
+            self.ready.notify()
+        self.sock.close()
+
+
+class StreamConnection(Connection):
+    # asyncio counterpart of SocketConnection, the writer is a task on the event loop
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        # drain returns once the transport has handed every byte to the kernel
+        writer.transport.set_write_buffer_limits(0)
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._write())
+
+    def __repr__(self):
+        return '<StreamConnection peer={}>'.format(self.peer)
+
+    def sendall(self, data, chat=False, bounded=True):
+        if self._push(data, chat, bounded):
+            self.ready.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                if write_delay > 0 and self.outbound_bytes < WRITE_BATCH_BYTES:
+                    await asyncio.sleep(write_delay)
+                while len(self.outbound) > 0:
+                    self.unsent = self._pop_batch()
+                    self.writer.writelines(self.unsent)
+                    await self.writer.drain()
+                    self.unsent = []
+                self.ready.clear()
+        except (OSError, asyncio.CancelledError):
+            pass
+
+    def evict(self):
+        # abort the transport, the reader sees the connection closed and cleans up
+        self.closed = True
+        self.writer.transport.abort()
+
+    def take_outbound(self):
+        # the transport took the last batch whole and may have lost any part of it when the
+        # connection died, a resume cannot tell which frames reached the peer
+        if len(self.unsent) > 0:
+            self.dropped += 1
+            self.unsent = []
+        return super().take_outbound()
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+
+
+class ReactorConnection(Connection):
+    # non-blocking socket of the reactor engine: frames wait in the outbound queue and are
+    # written once per reactor pass, the socket is watched for writing only while the
+    # kernel buffer is full
+    def __init__(self, sock, peer, reactor):
+        super().__init__()
+        self.sock = sock
+        self.peer = peer
+        self.reactor = reactor
+        self.decoder = FrameDecoder(negotiate=True)
+        self.scheduled = False
+        self.writing = False
+
+    def __repr__(self):
+        return '<ReactorConnection peer={}>'.format(self.peer)
+
+    def sendall(self, data, chat=False, bounded=True):
+        if self._push(data, chat, bounded) and not self.scheduled and not self.writing:
+            self.scheduled = True
+            if write_delay > 0 and self.outbound_bytes < WRITE_BATCH_BYTES:
+                self.reactor.call_later(write_delay, self.flush)
             else:
-                response = THTTP_Response(status_code='400', body='Corrupted request!')
-                send(repr(response))
+                self.reactor.call_soon(self.flush)
+
+    def ready(self, sock, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ:
+            self.read()
 
+    def read(self):
+        try:
+            data = self.sock.recv(BUFSIZE)
+            if not data:
+                raise ConnectionError('Connection closed by peer.')
+            for message in receive(self, self.decoder, data):
+                log.trace('request', peer=self, message=message)
+                serve(self, message)
+        except (BlockingIOError, InterruptedError):
+            pass
         except Exception as e:
-            print(e)
-            print('{} closed'.format(repr(connect)))
-            # leave group
-            member_text = chat.member_text(connect, other=connect)
-            members = chat.member_of(connect)
-            success, description = chat.leave(connect)
-            if success is True:
-                # update the members' list in other members
-                member_response = THTTP_Response(status_code='204', body=member_text)
-                for c in members:
-                    if c != connect:
-                        c.sendall(repr(member_response).encode())
-            # sign out
-            success, _ = chat.sign_out(connect)
+            log.info('closed', peer=self, reason=e)
+            disconnect(self)
+            self.close()
+
+    def flush(self):
+        self.scheduled = False
+        if self.closed:
+            return
+        try:
+            while len(self.unsent) > 0 or len(self.outbound) > 0:
+                if len(self.unsent) == 0:
+                    self.unsent = self._pop_batch()
+                self.unsent = self._send_some(self.unsent)
+                if len(self.unsent) > 0:
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # the reader sees the connection closed and cleans up
+            self.evict()
+            return
+        writing = len(self.unsent) > 0 or len(self.outbound) > 0
+        if writing != self.writing:
+            self.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self.reactor.modify(self.sock, events, self.ready)
+
+    def _send_some(self, batch):
+        # one non-blocking write, returns what the socket did not take
+        if hasattr(self.sock, 'sendmsg'):
+            sent = self.sock.sendmsg(batch)
+        else:
+            batch = [b''.join(batch)]
+            sent = self.sock.send(batch[0])
+        i = 0
+        while i < len(batch) and sent >= len(batch[i]):
+            sent -= len(batch[i])
+            i += 1
+        if i == len(batch):
+            return []
+        return [memoryview(batch[i])[sent:]] + batch[i + 1:]
+
+    def evict(self):
+        # make the next read fail, it runs the disconnect cleanup
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.reactor.unregister(self.sock)
+        self.sock.close()
+
+
+class HeldConnection(Connection):
+    # stands in for a dropped connection while its session waits for a resume: the frames
+    # it had not written and those sent since queue up to the high-water marks, then go to
+    # the resuming connection in order. A session that lost any of them cannot resume
+    def __init__(self, connect):
+        super().__init__(connect.policy)
+        self.version = connect.version
+        self.compress = connect.compress
+        self.deltas = connect.deltas
+        self.peer = connect.peer
+        # the dropped connection, the frames it refused before or after the transfer are lost
+        # to the session too
+        self.origin = connect
+        self.lock = threading.Lock()
+        # the resuming connection, set once the queued frames are handed over
+        self.successor = None
+
+    def __repr__(self):
+        return '<HeldConnection peer={}>'.format(self.peer)
+
+    def sendall(self, data, chat=False, bounded=True):
+        with self.lock:
+            if self.successor is None:
+                self._push(data, chat, bounded)
+                return
+        self.successor.sendall(data, chat)
+
+    def lost(self):
+        # a frame for the session was dropped here or by the dropped connection
+        return self.closed or self.dropped > 0 or self.origin.dropped > 0
+
+    def take_over(self, connect):
+        # the frames connect had not written yet, which were within its marks, go before
+        # any sent here since the transfer
+        with self.lock:
+            frames, self.outbound = self.outbound, connect.take_outbound()
+            self.outbound_bytes = sum(len(data) for data, _ in self.outbound)
+            for data, chat in frames:
+                self._push(data, chat)
+
+    def hand_over(self, connect):
+        # the queued frames in one write, anything sent here afterwards is passed on. They
+        # fit the high-water marks, with the resume reply ahead of them they may not
+        with self.lock:
+            if len(self.outbound) > 0:
+                connect.sendall(b''.join(data for data, _ in self.outbound), bounded=False)
+                self.outbound.clear()
+                self.outbound_bytes = 0
+            self.successor = connect
+
+    def evict(self):
+        # past the high-water marks with the disconnect policy, the session is not resumable
+        self.closed = True
+
+
+class SessionHolder:
+    # signed in sessions of dropped connections, held grace seconds under their resume
+    # token. The group sees no leave unless the grace period ends without a resume, the
+    # timer wheel entries of resumed sessions are skipped when they fire
+    def __init__(self, grace=RESUME_GRACE, tick=REAPER_TICK):
+        self.grace = grace
+        self.tick = tick
+        self.wheel = TimerWheel(time.monotonic(), tick)
+        self.lock = threading.Lock()
+        # token -> HeldConnection
+        self.held = {}
+
+    def hold(self, connect):
+        # False when connect has no session to hold, the caller then ends it
+        token = chat.token_of(connect)
+        if self.grace <= 0 or token == '':
+            return False
+        held = HeldConnection(connect)
+        if not chat.transfer(connect, held):
+            return False
+        held.take_over(connect)
+        with self.lock:
+            self.held[token] = held
+            self.wheel.schedule(time.monotonic() + self.grace, (token, held))
+        if bus is not None:
+            bus.hold(token, chat.username_of(held))
+        log.info('held', peer=connect, grace=self.grace)
+        return True
+
+    def take(self, token):
+        with self.lock:
+            held = self.held.pop(token, None)
+        if held is not None and bus is not None:
+            bus.unhold(token)
+        return held
+
+    def expire(self, now):
+        with self.lock:
+            expired = []
+            for token, held in self.wheel.advance(now):
+                if self.held.get(token) is held:
+                    del self.held[token]
+                    expired.append((token, held))
+        for token, held in expired:
+            if bus is not None:
+                bus.unhold(token)
+            log.info('expired', peer=held)
+            end_session(held)
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.expire(time.monotonic())
+
+    async def run_async(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.expire(time.monotonic())
+
+
+class Reaper:
+    # evicts connections that sent nothing for timeout seconds, the reader then runs the
+    # usual leave and sign out cleanup. Only connections that have pinged are watched, one
+    # that never pings may quietly read a room for as long as it likes. Each watched
+    # connection has one entry in a timer wheel, rescheduled lazily from last_active when
+    # it fires, so reads never touch the wheel
+    def __init__(self, timeout=IDLE_TIMEOUT, tick=REAPER_TICK):
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel = TimerWheel(time.monotonic(), tick)
+        # filled from any thread, moved into the wheel on the reaper's own tick
+        self.pending = deque()
+
+    def watch(self, connect):
+        self.pending.append(connect)
+
+    def reap(self, now):
+        while len(self.pending) > 0:
+            connect = self.pending.popleft()
+            self.wheel.schedule(connect.last_active + self.timeout, connect)
+        for connect in self.wheel.advance(now):
+            if connect.closed:
+                continue
+            deadline = connect.last_active + self.timeout
+            if deadline > now:
+                self.wheel.schedule(deadline, connect)
+            else:
+                log.info('idle', peer=connect)
+                connect.evict()
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.reap(time.monotonic())
+
+    async def run_async(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.reap(time.monotonic())
+
+
+class MemberUpdates:
+    # joins and leaves reach the other members as 208 and 209 deltas, coalesced per group
+    # over interval seconds, so a join storm into a big room costs one frame per member
+    # per interval instead of a full member list per join. Members that did not sign in
+    # with Member-Updates: delta get the full 204 list instead, as they always have
+    def __init__(self, interval=MEMBER_DEBOUNCE):
+        self.interval = interval
+        # groups with changes, filled from any thread
+        self.pending = deque()
+
+    def changed(self, group):
+        self.pending.append(group)
+
+    def flush(self):
+        groups = set()
+        while len(self.pending) > 0:
+            groups.add(self.pending.popleft())
+        for group in groups:
+            joined, left = chat.take_changes(group)
+            if len(joined) == 0 and len(left) == 0:
+                continue
+            members = chat.members(group)
+            deltas = [c for c in members if c.deltas]
+            if len(deltas) < len(members):
+                usernames = [chat.username_of(c) for c in members] if bus is None else bus.members(group)
+                send_all([c for c in members if not c.deltas], THTTP_Response(status_code='204', body=','.join(usernames)))
+            if len(left) > 0:
+                send_all(deltas, THTTP_Response(status_code='209', body=','.join(left)))
+            if len(joined) > 0:
+                send_all(deltas, THTTP_Response(status_code='208', body=','.join(joined)))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if len(self.pending) > 0:
+                fanout(self.flush)
+
+    async def run_async(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if len(self.pending) > 0:
+                self.flush()
+
+
+def set_nodelay(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if tcp_nodelay else 0)
+
+
+def set_keepalive(sock):
+    # the reaper only watches connections that ping, the kernel finds the half-open ones
+    # among the others; platforms without the tuning options keep their default timing
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+SLOW_DOWN = THTTP_Response.constant('401', 'Slow down.')
+SERVER_BUSY = THTTP_Response.constant('402', 'Server busy, try again later.')
+
+
+def _inline(func, *args):
+    func(*args)
+
+
+# runs broadcast deliveries, the engines replace it with a worker so senders never wait
+fanout = _inline
+# runs requests that carry a request id, None processes them in order on the reader
+request_pool = None
+# seconds a connection's writer waits for more frames before writing them together
+write_delay = WRITE_DELAY
+# False lets the kernel also merge small segments (Nagle), trading latency for throughput
+tcp_nodelay = TCP_NODELAY
+# runs a function on the event loop from another thread, None on the thread engine
+call_soon_threadsafe = None
+
+
+def broadcast(group, response, other=None, record=False):
+    # O(1) for the caller whatever the group size, members get the frame from fanout
+    fanout(deliver, group, response, other, record)
+
+
+def log_event(event, group, username, body=''):
+    # with worker processes the hub logs the event, the bus passes it on to the other
+    # workers or cluster nodes
+    if bus is not None:
+        bus.publish(event, group, username, body)
+    if chat_log is not None:
+        chat_log.append(event, group, username, body)
+
+
+def release(username):
+    if bus is not None:
+        bus.release(username)
+
+
+def ask(connect, call, arg, done):
+    # call is bus.claim or bus.forfeit, done gets its answer, None when the cluster cannot
+    # answer. The thread engine waits, the loop engines serve the other connections
+    # meanwhile and hold the later requests of connect until done has run
+    if call_soon_threadsafe is None:
+        done(call(arg))
+        return
+
+    def claimed(ok):
+        pending, connect.pending = connect.pending, None
+        done(ok)
+        for i, request in enumerate(pending):
+            if connect.closed:
+                break
+            if connect.pending is not None:
+                # another request waits for the bus
+                connect.pending.extend(pending[i:])
+                break
+            process(connect, request)
+
+    connect.pending = []
+    call(arg, lambda ok: call_soon_threadsafe(claimed, ok))
+
+
+def relay(message):
+    # an event of another worker or node, for the members of the group here
+    event, group, username, body = message
+    if event == 'send':
+        response = THTTP_Response(status_code='205', body="{}: {}".format(username, body))
+        deliver(group, response, record=True)
+    elif event == 'evict':
+        evict(username)
+    elif event == 'forfeit':
+        # the resume went to another worker, which got the name back from the hub
+        held = holder.take(body)
+        if held is not None:
+            log.info('forfeited', peer=held, username=username)
+            end_session(held)
+    elif chat.note_change(group, username, event == 'join'):
+        member_updates.changed(group)
+
+
+def evict(username):
+    # the owner node gave the name to another user while the link to it was down
+    connect = chat.connection_of(username)
+    if connect is None:
+        return
+    log.warning('name taken', peer=connect, username=username)
+    if isinstance(connect, HeldConnection):
+        holder.take(chat.token_of(connect))
+        end_session(connect)
+        return
+    group = chat.group_of(connect)
+    success, description = chat.leave(connect)
+    if success is True:
+        log_event('leave', group, username)
+        member_updates.changed(group)
+        connect.send(EMPTY_MEMBERS)
+        connect.send(THTTP_Response(status_code='203', body=description))
+    chat.sign_out(connect)
+    connect.send(THTTP_Response(status_code='201', body='Signed out, {} is taken on another node.'.format(username)))
+
+
+def restore(directory):
+    # rebuild the group history from the chat log after a restart
+    for record in read_records(directory):
+        if record['e'] == 'send':
+            text = "{}: {}".format(record['u'], record['b'])
+            chat.record(record['g'], THTTP_Response(status_code='205', body=text))
+
+
+def deliver(group, response, other=None, record=False):
+    # response.encode caches, so it encodes (and compresses) once per wire format, not once per member;
+    # with record the response also goes into the group history
+    members = chat.record(group, response) if record else chat.members(group)
+    send_all(members, response, other)
+
+
+def send_all(members, response, other=None):
+    start = time.perf_counter()
+    is_chat = response.get_status_code() == '205'
+    for c in members:
+        if c != other:
+            c.sendall(response.encode(c.version, c.compress), is_chat)
+    metrics.fanout(len(members), time.perf_counter() - start)
+
+
+def replay(connect, history):
+    # the group's recent chat in one batched write
+    if len(history) > 0:
+        connect.sendall(b''.join(response.encode(connect.version, connect.compress) for response in history))
+
+
+def serve(connect, message):
+    # handle one request message from connect; with a request id and a request pool
+    # it runs there, so the requests of one connection are processed concurrently
+    request = THTTP_Request(message=message, version=connect.version)
+    if connect.pending is not None:
+        connect.pending.append(request)
+    elif request_pool is not None and request.get_header(REQUEST_ID) is not None:
+        request_pool.add_job(process, connect, request)
+    else:
+        process(connect, request)
+
+
+def process(connect, request):
+    start = time.perf_counter()
+    valid = request.check()
+    dispatch(connect, request, valid)
+    metrics.request(request.get_method() if valid else 'invalid', time.perf_counter() - start)
+
+
+def dispatch(connect, request, valid):
+    send = connect.send
+    request_id = request.get_header(REQUEST_ID)
+
+    def reply(response):
+        # the final response to the request echoes its id
+        if request_id is not None:
+            response = response.with_header(REQUEST_ID, request_id)
+        send(response)
+
+    if valid is False:
+        reply(CORRUPTED_REQUEST)
+    elif not connect.allow(request.get_method()):
+        reply(SLOW_DOWN)
+    elif request.get_method() == 'signin':
+        username = request.body
+        token = secrets.token_urlsafe(16) if holder.grace > 0 else ''
+
+        def signed_in(success, description):
             if success is True:
-                print('{} signed out'.format(connect))
+                response = THTTP_Response(status_code='200', body=description)
+                headers = []
+                if token != '':
+                    headers.append((RESUME_TOKEN, token))
+                if connect.version == VERSION_2 and ZLIB in (request.get_header(ACCEPT_ENCODING) or '').split(','):
+                    connect.compress = True
+                    headers.append((ACCEPT_ENCODING, ZLIB))
+                if request.get_header(MEMBER_UPDATES) == DELTA:
+                    connect.deltas = True
+                    headers.append((MEMBER_UPDATES, DELTA))
+                response.headers = headers
             else:
-                print('{} signed out error'.format(connect))
+                response = THTTP_Response(status_code='300', body=description)
+            reply(response)
+
+        def claimed(ok):
+            if chat.username_of(connect) != username:
+                # the connection closed meanwhile, its session has ended
+                return
+            if ok is not True:
+                chat.sign_out(connect)
+            if ok is None:
+                # the owner of the name is another node that cannot be reached
+                signed_in(False, 'Cluster unavailable.')
+            else:
+                signed_in(ok, description if ok else 'Username collision.')
+
+        success, description = chat.sign_in(connect, username, token)
+        if success is True and bus is not None:
+            ask(connect, bus.claim, username, claimed)
+        else:
+            signed_in(success, description)
+    elif request.get_method() == 'signout':
+        username = chat.username_of(connect)
+        success, description = chat.sign_out(connect)
+        if success is True:
+            release(username)
+            response = THTTP_Response(status_code='201', body=description)
+        else:
+            response = THTTP_Response(status_code='301', body=description)
+        reply(response)
+    elif request.get_method() == 'join':
+        group = request.body
+        # the members of the other workers or nodes, asked before the group lock is taken
+        others = None if bus is None else bus.members(group)
+
+        def welcome(description, history, members):
+            # the full list only to the new member, the others get a 208 delta
+            if others is None:
+                usernames = [chat.username_of(c) for c in members]
+            else:
+                usernames = others + [chat.username_of(connect)]
+            send(THTTP_Response(status_code='204', body=','.join(usernames)))
+            reply(THTTP_Response(status_code='202', body=description))
+            replay(connect, history)
+
+        success, description = chat.join(connect, group, welcome)
+        if success is True:
+            log_event('join', group, chat.username_of(connect))
+            member_updates.changed(group)
+        else:
+            reply(THTTP_Response(status_code='302', body=description))
+    elif request.get_method() == 'leave':
+        group = chat.group_of(connect)
+        success, description = chat.leave(connect)
+        if success is True:
+            log_event('leave', group, chat.username_of(connect))
+            response = THTTP_Response(status_code='203', body=description)
+            # the other members get a 209 delta
+            member_updates.changed(group)
+            send(EMPTY_MEMBERS)
+        else:
+            response = THTTP_Response(status_code='303', body=description)
+        reply(response)
+    elif request.get_method() == 'send':
+        success, description = chat.send(connect)
+        if success is True and len(request.body) > MAX_CHAT_LENGTH:
+            # would not fit in the outbound queues of the members
+            success, description = False, 'Message too long.'
+        if success is True:
+            text = "{}: {}".format(chat.username_of(connect), request.body)
+            response = THTTP_Response(status_code='205', body=text)
+            group = chat.group_of(connect)
+            if request_id is None:
+                broadcast(group, response, record=True)
+            else:
+                # the sender's copy is its reply
+                broadcast(group, response, other=connect, record=True)
+                reply(THTTP_Response(status_code='205', body=text))
+            log_event('send', group, chat.username_of(connect), request.body)
+        else:
+            response = THTTP_Response(status_code='305', body=description)
+            reply(response)
+    elif request.get_method() == 'ping':
+        # a client that pings keeps doing so, from now on it is reaped when it goes quiet
+        if not connect.heartbeat:
+            connect.heartbeat = True
+            reaper.watch(connect)
+        response = THTTP_Response(status_code='207', body=request.body)
+        reply(response)
+    elif request.get_method() == 'stats':
+        response = THTTP_Response(status_code='206', body=json.dumps(metrics.snapshot()))
+        if not response.with_header(REQUEST_ID, request_id or '').fits(connect.version):
+            # a THTTP/1.1 frame holds 999 characters: the request counts and gauges only
+            response = THTTP_Response(status_code='206', body=json.dumps(metrics.summary(), separators=(',', ':')))
+        if not response.with_header(REQUEST_ID, request_id or '').fits(connect.version):
+            response = THTTP_Response(status_code='400', body='Stats do not fit in THTTP/1.1, use THTTP/2 or --stats-port.')
+        reply(response)
+    elif request.get_method() == 'resume':
+        held = None
+        if chat.username_of(connect) == '':
+            held = holder.take(request.body)
+            if held is None and bus is not None:
+                # the session may be held by another worker, which ends it, the name is free
+                # for a fresh sign in by the time of the reply
+                ask(connect, bus.forfeit, request.body,
+                    lambda ok: reply(THTTP_Response(status_code='306', body='Session ended.' if ok else 'No session to resume.')))
+                return
+        if held is None:
+            reply(THTTP_Response(status_code='306', body='No session to resume.'))
+        elif held.lost() or held.version != connect.version:
+            # frames for it were dropped, or are in the other wire format, free the name for
+            # a fresh sign in
+            end_session(held)
+            reply(THTTP_Response(status_code='306', body='Session lost.'))
+        else:
+            connect.compress = held.compress
+            connect.deltas = held.deltas
+            response = THTTP_Response(status_code='210', body='Resume as {}.'.format(chat.username_of(held)))
+            response.headers = [(RESUME_TOKEN, request.body)]
+            if connect.compress:
+                response.headers.append((ACCEPT_ENCODING, ZLIB))
+            if connect.deltas:
+                response.headers.append((MEMBER_UPDATES, DELTA))
+            reply(response)
+            # the frames held for the session before anything sent to it from now on
+            held.hand_over(connect)
+            chat.transfer(held, connect)
+            log.info('resumed', peer=connect, username=chat.username_of(connect))
+    else:
+        reply(CORRUPTED_REQUEST)
+
+
+def disconnect(connect):
+    # a signed in session is held for a resume, it ends if the grace period runs out.
+    # One still waiting for its claim ends at once
+    if connect.pending is not None or not holder.hold(connect):
+        end_session(connect)
+
+
+def end_session(connect):
+    # leave group
+    group = chat.group_of(connect)
+    success, description = chat.leave(connect)
+    if success is True:
+        log_event('leave', group, chat.username_of(connect))
+        member_updates.changed(group)
+    # sign out
+    username = chat.username_of(connect)
+    success, _ = chat.sign_out(connect)
+    if success is True:
+        release(username)
+        log.debug('signed out', peer=connect)
+    else:
+        log.debug('signed out error', peer=connect)
+    chat.disconnect(connect)
+
+
+def receive(connect, decoder, data):
+    # decode the bytes just read, switching connect to v2 if it opened with the preface
+    connect.last_active = time.monotonic()
+    messages = decoder.feed(data)
+    if decoder.version != connect.version:
+        connect.upgrade(decoder.version)
+    return messages
+
+
+def serve_connection(sock, address):
+    connect = SocketConnection(sock, address)
+    chat.connect(connect)
+    handle_request(connect)
+
+
+def refuse(sock):
+    # every thread busy and the queue full, say so instead of leaving the client waiting
+    try:
+        sock.sendall(SERVER_BUSY.encode())
+    except OSError:
+        pass
+    sock.close()
+
+
+def handle_request(connect):
+    decoder = FrameDecoder(negotiate=True)
+    while True:
+        try:
+            data = connect.recv(BUFSIZE)
+            if not data:
+                raise ConnectionError('Connection closed by peer.')
+            for message in receive(connect, decoder, data):
+                log.trace('request', thread=threading.current_thread().name, message=message)
+                serve(connect, message)
+        except Exception as e:
+            log.info('closed', peer=connect, reason=e)
+            disconnect(connect)
             # kill loop
             break
 
     connect.close()
 
-    
-if __name__ == "__main__":
-    print("Server is starting")
+
+async def handle_request_async(reader, writer):
+    set_nodelay(writer.get_extra_info('socket'))
+    set_keepalive(writer.get_extra_info('socket'))
+    connect = StreamConnection(writer)
+    chat.connect(connect)
+    decoder = FrameDecoder(negotiate=True)
+    while True:
+        try:
+            data = await reader.read(BUFSIZE)
+            if not data:
+                raise ConnectionError('Connection closed by peer.')
+            for message in receive(connect, decoder, data):
+                log.trace('request', peer=connect, message=message)
+                serve(connect, message)
+        except Exception as e:
+            log.info('closed', peer=connect, reason=e)
+            disconnect(connect)
+            break
+
+    connect.close()
+
+
+def run_thread_server(request_threads=REQUEST_THREAD, reuse_port=False, port=PORT,
+                      min_threads=MIN_THREAD, max_threads=MAX_THREAD):
+    global fanout, request_pool
+    # applies to every thread started from now on, connection threads need little stack
+    threading.stack_size(THREAD_STACK_SIZE)
+    fanout_pool = ThreadPoolManger(1)
+    fanout = fanout_pool.add_job
+    if request_threads > 0:
+        request_pool = ThreadPoolManger(request_threads)
+        metrics.gauge('request_queue', request_pool.work_queue.qsize)
+    if bus is not None:
+        bus.start(lambda message: fanout(relay, message))
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind((HOST, PORT))
+    # restart at once, without waiting for the last run's connections to leave TIME_WAIT
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, port))
     sock.listen(MAX_THREAD)
-    print("Server is running on ({}, {}), with max connection {}".format(HOST, PORT, MAX_THREAD))
+    log.info('running', host=HOST, port=port, engine='thread', min_threads=min_threads, max_threads=max_threads)
 
-    thread_pool = ThreadPoolManger(MAX_THREAD)
-    chat = ChatRoom()
+    thread_pool = ElasticThreadPool(min_threads, max_threads)
+    threading.Thread(target=reaper.run, daemon=True).start()
+    threading.Thread(target=member_updates.run, daemon=True).start()
+    threading.Thread(target=holder.run, daemon=True).start()
+    metrics.gauge('work_queue', lambda: len(thread_pool.jobs))
+    metrics.gauge('threads', lambda: thread_pool.threads)
+    metrics.gauge('idle_threads', lambda: thread_pool.threads - thread_pool.busy)
+    metrics.gauge('refused', lambda: thread_pool.refused)
+    metrics.gauge('fanout_queue', fanout_pool.work_queue.qsize)
     try:
         while True:
             conn, address = sock.accept()
-            chat.connect(conn)
+            set_nodelay(conn)
+            set_keepalive(conn)
             # handle request
-            thread_pool.add_job(handle_request, *(conn, ))
+            if not thread_pool.submit(serve_connection, conn, address):
+                log.warning('busy', peer=address)
+                refuse(conn)
     except Exception as e:
-        print(e)
+        log.error('accept failed', reason=e)
         sock.close()
+
+
+async def run_asyncio_server(reuse_port=False, port=PORT):
+    global fanout, call_soon_threadsafe
+    loop = asyncio.get_running_loop()
+    fanout = loop.call_soon
+    call_soon_threadsafe = loop.call_soon_threadsafe
+    if bus is not None:
+        bus.start(lambda message: loop.call_soon_threadsafe(relay, message))
+    reaper_task = loop.create_task(reaper.run_async())
+    member_task = loop.create_task(member_updates.run_async())
+    holder_task = loop.create_task(holder.run_async())
+    server = await asyncio.start_server(handle_request_async, HOST, port, backlog=ASYNC_BACKLOG, reuse_port=reuse_port)
+    log.info('running', host=HOST, port=port, engine='asyncio')
+    async with server:
+        await server.serve_forever()
+
+
+def run_reactor_server(reuse_port=False, port=PORT):
+    # every connection on one thread through the selector, so the ChatRoom needs no locks
+    global fanout, call_soon_threadsafe
+    reactor = Reactor()
+    fanout = reactor.call_soon
+    call_soon_threadsafe = reactor.call_soon_threadsafe
+    chat.single_threaded()
+    if bus is not None:
+        bus.start(lambda message: reactor.call_soon_threadsafe(relay, message))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, port))
+    sock.listen(ASYNC_BACKLOG)
+    sock.setblocking(False)
+
+    def accept(sock, mask):
+        # a bounded batch per pass, so a connection storm does not hold up the reads
+        for _ in range(ACCEPT_BATCH):
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.error('accept failed', reason=e)
+                return
+            conn.setblocking(False)
+            set_nodelay(conn)
+            set_keepalive(conn)
+            connect = ReactorConnection(conn, address, reactor)
+            chat.connect(connect)
+            reactor.register(conn, selectors.EVENT_READ, connect.ready)
+
+    reactor.register(sock, selectors.EVENT_READ, accept)
+    reactor.every(reaper.tick, lambda: reaper.reap(time.monotonic()))
+    reactor.every(member_updates.interval, member_updates.flush)
+    reactor.every(holder.tick, lambda: holder.expire(time.monotonic()))
+    metrics.gauge('fanout_queue', lambda: len(reactor.ready))
+    metrics.gauge('timers', lambda: len(reactor.timers))
+    log.info('running', host=HOST, port=port, engine='reactor', selector=type(reactor.selector).__name__)
+    reactor.run()
+
+
+def run_worker(worker, address, args):
+    # one of --workers processes, sharing the port with the others through SO_REUSEPORT
+    global bus, write_delay, tcp_nodelay
+    log.configure(args.log_level, args.log_sample)
+    write_delay = args.write_delay
+    tcp_nodelay = args.nodelay
+    holder.grace = args.resume_grace
+    limit_sends(args.send_rate)
+    signal.signal(signal.SIGTERM, stop)
+    bus = Bus(address, worker, lost=stop_worker)
+    if args.stats_port is not None:
+        serve_http(metrics, HOST, args.stats_port + worker)
+    if args.log_dir is not None:
+        restore(args.log_dir)
+    try:
+        if args.engine == 'asyncio':
+            asyncio.run(run_asyncio_server(reuse_port=True, port=args.port))
+        elif args.engine == 'reactor':
+            run_reactor_server(reuse_port=True, port=args.port)
+        else:
+            run_thread_server(args.request_threads, reuse_port=True, port=args.port,
+                              min_threads=args.min_threads, max_threads=args.max_threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.close()
+
+
+def limit_sends(rate):
+    # sends per second and connection, with a burst of two seconds' worth, 0 for no limit
+    if rate > 0:
+        RATE_LIMITS['send'] = (rate, 2 * rate)
+    else:
+        RATE_LIMITS.pop('send', None)
+
+
+def stop(signum, frame):
+    # SIGTERM unwinds the main thread, so the finally blocks close the logs
+    raise SystemExit(0)
+
+
+def stop_worker():
+    # the hub died with the parent, without it no name can be claimed
+    log.warning('hub lost')
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run_workers(args):
+    # the parent runs the hub, which keeps usernames and groups consistent across workers,
+    # and writes the chat log for all of them. Stopping it stops the workers
+    address = os.path.join(tempfile.mkdtemp(), 'bus')
+    hub = Hub(address, chat_log)
+    threading.Thread(target=hub.serve, daemon=True).start()
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(worker, address, args), daemon=True)
+               for worker in range(args.workers)]
+    for process in workers:
+        process.start()
+    log.info('running', host=HOST, port=args.port, engine=args.engine, workers=args.workers)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in workers:
+            process.join()
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+
+log = Logger()
+chat = ChatRoom()
+reaper = Reaper()
+member_updates = MemberUpdates()
+holder = SessionHolder()
+metrics = Metrics()
+metrics.gauge('connections', lambda: len(chat.connection))
+metrics.gauge('users', lambda: len(chat.user))
+metrics.gauge('groups', lambda: len(chat.group))
+metrics.gauge('idle_timers', lambda: len(reaper.wheel))
+metrics.gauge('held_sessions', lambda: len(holder.held))
+# durable event log, enabled with --log-dir
+chat_log = None
+# the hub in a worker process of --workers, or the cluster peers with --cluster
+bus = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Chat room server')
+    parser.add_argument('--port', type=int, default=PORT, help='port for clients')
+    parser.add_argument('--engine', choices=['thread', 'asyncio', 'reactor'], default=ENGINE,
+                        help='thread: one pooled thread per connection; asyncio: one event loop for all connections; '
+                             'reactor: one selector thread for all connections, without locks')
+    parser.add_argument('--min-threads', type=int, default=MIN_THREAD,
+                        help='thread engine: connection threads kept when idle')
+    parser.add_argument('--max-threads', type=int, default=MAX_THREAD,
+                        help='thread engine: most connections served at once, more wait in a short queue '
+                             'and are then refused with 402')
+    parser.add_argument('--request-threads', type=int, default=REQUEST_THREAD,
+                        help='thread engine: run requests that carry a request id on this many threads, '
+                             '0 runs every request in order on the connection thread')
+    parser.add_argument('--log-dir', default=LOG_DIR,
+                        help='append send/join/leave events to this directory and restore group history from it')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='also serve the stats snapshot as JSON on http://HOST:PORT/stats')
+    parser.add_argument('--log-level', choices=list(LEVELS), default=LOG_LEVEL,
+                        help='diagnostic log level, debug also logs every request')
+    parser.add_argument('--log-sample', type=int, default=LOG_SAMPLE,
+                        help='at debug level, log one in every N requests')
+    parser.add_argument('--write-delay', type=float, default=WRITE_DELAY,
+                        help='seconds each connection gathers outgoing frames before one write, 0 writes at once')
+    parser.add_argument('--nodelay', action=argparse.BooleanOptionalAction, default=TCP_NODELAY,
+                        help='set TCP_NODELAY on client connections')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help='seconds the session of a dropped connection is held for a resume, 0 disables resume')
+    parser.add_argument('--send-rate', type=float, default=RATE_LIMITS['send'][0],
+                        help='messages per second each connection may send, more get 401, 0 for no limit')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='run this many server processes on the same port (SO_REUSEPORT), '
+                             'with --stats-port worker N serves stats on port STATS_PORT + N')
+    parser.add_argument('--cluster', default=CLUSTER,
+                        help='HOST:PORT this node links to the other cluster nodes on')
+    parser.add_argument('--peers', default=PEERS,
+                        help='comma-separated HOST:PORT cluster addresses of the other nodes, the same on every node')
+    parser.add_argument('--cluster-key', default=CLUSTER_KEY,
+                        help='shared secret the nodes authenticate their links with')
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT')
+    if args.workers > 1 and args.cluster is not None:
+        parser.error('--workers and --cluster cannot be combined')
+    if args.cluster is not None and args.cluster_key is None and not is_loopback(parse_address(args.cluster)):
+        parser.error('--cluster on an address other hosts can reach needs --cluster-key')
+
+    write_delay = args.write_delay
+    tcp_nodelay = args.nodelay
+    holder.grace = args.resume_grace
+    limit_sends(args.send_rate)
+    log.configure(args.log_level, args.log_sample)
+    log.info('starting')
+    # with --workers the workers serve the stats and restore the history, the parent only writes the log
+    if args.stats_port is not None and args.workers == 1:
+        serve_http(metrics, HOST, args.stats_port)
+    if args.log_dir is not None:
+        if args.workers == 1:
+            restore(args.log_dir)
+        chat_log = ChatLog(args.log_dir)
+    if args.cluster is not None:
+        peers = [parse_address(peer) for peer in args.peers.split(',') if peer != '']
+        authkey = None if args.cluster_key is None else args.cluster_key.encode()
+        bus = Federation(parse_address(args.cluster), peers, authkey)
+    try:
+        if args.workers > 1:
+            run_workers(args)
+        elif args.engine == 'asyncio':
+            asyncio.run(run_asyncio_server(port=args.port))
+        elif args.engine == 'reactor':
+            run_reactor_server(port=args.port)
+        else:
+            run_thread_server(args.request_threads, port=args.port,
+                              min_threads=args.min_threads, max_threads=args.max_threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if chat_log is not None:
+            chat_log.close()
+        log.close()
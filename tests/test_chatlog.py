@@ -0,0 +1,23 @@
+import os
+from chatlog import ChatLog, read_records, segment_paths
+
+
+def test_torn_line_is_cut_on_reopen(tmp_path):
+    log = ChatLog(str(tmp_path))
+    log.append('send', 'g', 'alice', 'one')
+    log.close()
+    with open(segment_paths(str(tmp_path))[-1], 'ab') as f:
+        f.write(b'{"t": 1, "e": "se')
+    log = ChatLog(str(tmp_path))
+    log.append('send', 'g', 'alice', 'two')
+    log.close()
+    assert [record['b'] for record in read_records(str(tmp_path))] == ['one', 'two']
+
+
+def test_old_segments_are_retired(tmp_path):
+    log = ChatLog(str(tmp_path), segment_size=1, commit_interval=0, max_segments=2)
+    for i in range(5):
+        log.append('send', 'g', 'alice', str(i))
+    log.close()
+    assert len(os.listdir(str(tmp_path))) <= 2
+    assert [record['b'] for record in read_records(str(tmp_path))][-1] == '4'
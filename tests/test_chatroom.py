@@ -0,0 +1,115 @@
+from protocol import THTTP_Response, VERSION_2
+from server import ChatRoom
+
+
+def chat_response(text):
+    return THTTP_Response(status_code='205', body=text)
+
+
+def signed_in(chat, *usernames, group=None):
+    # one connection per username, the plain objects benchmarks/chatroom.py uses
+    connections = []
+    for username in usernames:
+        connect = object()
+        chat.connect(connect)
+        assert chat.sign_in(connect, username) == (True, 'Sign in as {}.'.format(username))
+        if group is not None:
+            assert chat.join(connect, group)[0] is True
+        connections.append(connect)
+    return connections
+
+
+def test_username_collision():
+    chat = ChatRoom()
+    alice, = signed_in(chat, 'alice')
+    other = object()
+    chat.connect(other)
+    assert chat.sign_in(other, 'alice') == (False, 'Username collision.')
+    assert chat.sign_in(alice, 'bob') == (False, 'Already signed in.')
+    assert chat.connection_of('alice') is alice
+    assert chat.username_of(other) == ''
+    # the name is free again once its user signs out or disconnects
+    assert chat.sign_out(alice) == (True, 'Sign out successful.')
+    assert chat.sign_in(other, 'alice')[0] is True
+    chat.disconnect(other)
+    assert chat.connection_of('alice') is None
+
+
+def test_join_and_leave():
+    chat = ChatRoom()
+    stranger = object()
+    chat.connect(stranger)
+    assert chat.join(stranger, 'g') == (False, 'Not signed in.')
+    alice, bob = signed_in(chat, 'alice', 'bob', group='g')
+    assert chat.join(alice, 'h') == (False, 'Already in a group.')
+    assert sorted(chat.members('g'), key=id) == sorted([alice, bob], key=id)
+    assert chat.sign_out(alice) == (False, 'Leave group first.')
+    assert chat.take_changes('g') == (['alice', 'bob'], [])
+    assert chat.leave(alice) == (True, 'Leave group successful.')
+    assert chat.leave(alice) == (False, 'Not in a group.')
+    assert chat.take_changes('g') == ([], ['alice'])
+    assert chat.members('g') == (bob, )
+    # an empty group without history is forgotten
+    chat.leave(bob)
+    assert 'g' not in chat.group
+
+
+def test_welcome_sees_history_and_members():
+    chat = ChatRoom()
+    alice, = signed_in(chat, 'alice', group='g')
+    chat.record('g', chat_response('alice: hi'))
+    bob, = signed_in(chat, 'bob')
+    welcomed = []
+    chat.join(bob, 'g', lambda description, history, members: welcomed.append((description, history, members)))
+    description, history, members = welcomed[0]
+    assert description == 'Join group g.'
+    assert [response.body for response in history] == ['alice: hi']
+    assert set(members) == {alice, bob}
+
+
+def test_transfer_keeps_name_and_group_without_a_change():
+    chat = ChatRoom()
+    old, bob = signed_in(chat, 'alice', 'bob', group='g')
+    chat.take_changes('g')
+    new = object()
+    assert chat.transfer(old, new) is True
+    assert chat.connection_of('alice') is new
+    assert chat.username_of(new) == 'alice'
+    assert chat.group_of(new) == 'g'
+    assert set(chat.members('g')) == {new, bob}
+    assert old not in chat.connection
+    assert chat.take_changes('g') == ([], [])
+    # a connection that is not signed in has no session to transfer
+    stranger = object()
+    chat.connect(stranger)
+    assert chat.transfer(stranger, object()) is False
+
+
+def test_record_caps_history_by_count_and_bytes():
+    size = len(chat_response('x' * 10).encode(VERSION_2))
+    chat = ChatRoom(max_history=3, max_history_bytes=size * 10)
+    alice, = signed_in(chat, 'alice', group='g')
+    for i in range(5):
+        assert chat.record('g', chat_response('{:010d}'.format(i))) == (alice, )
+    assert [response.body for response in chat.history('g')] == ['0000000002', '0000000003', '0000000004']
+    chat = ChatRoom(max_history=50, max_history_bytes=size * 2)
+    for i in range(5):
+        chat.record('g', chat_response('{:010d}'.format(i)))
+    assert [response.body for response in chat.history('g')] == ['0000000003', '0000000004']
+
+
+def test_idle_groups_are_trimmed_least_recently_used_first():
+    chat = ChatRoom(max_idle_groups=2)
+    for group in ('a', 'b', 'c'):
+        # no members, kept for the history alone
+        assert chat.record(group, chat_response(group)) == ()
+    assert sorted(chat.group) == ['b', 'c']
+    # a group with members is not idle, whatever its history
+    alice, = signed_in(chat, 'alice', group='b')
+    chat.record('d', chat_response('d'))
+    chat.record('e', chat_response('e'))
+    assert sorted(chat.group) == ['b', 'd', 'e']
+    # once empty it is the most recently used idle group
+    chat.leave(alice)
+    assert sorted(chat.group) == ['b', 'e']
+    assert [response.body for response in chat.history('b')] == ['b']
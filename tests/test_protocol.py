@@ -0,0 +1,143 @@
+import zlib
+import pytest
+from config import MAX_FRAME_SIZE
+from protocol import THTTP_Request, THTTP_Response, FrameDecoder, encode_varint, decode_varint, \
+    VERSION, VERSION_2, PREFACE, CONTENT_ENCODING, ZLIB
+
+
+def requests(version):
+    bodies = ['hello', '', '你好 héllo', 'x' * 900]
+    return [THTTP_Request(method='send', target='127.0.0.1', body=body) for body in bodies], \
+        b''.join(THTTP_Request(method='send', target='127.0.0.1', body=body).encode(version) for body in bodies)
+
+
+def parse(messages, version):
+    return [THTTP_Request(message=message, version=version).body for message in messages]
+
+
+@pytest.mark.parametrize('n', [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32, 2 ** 63 - 1])
+def test_varint_round_trip(n):
+    data = encode_varint(n) + b'rest'
+    assert decode_varint(data) == (n, len(data) - 4)
+
+
+def test_truncated_varint_waits_for_more():
+    data = encode_varint(300)
+    assert decode_varint(data[:1]) == (None, 1)
+    decoder = FrameDecoder(version=VERSION_2)
+    assert decoder.feed(data[:1]) == []
+    assert len(decoder) == 1
+
+
+def test_overlong_varint_is_rejected():
+    with pytest.raises(ValueError):
+        decode_varint(b'\xff' * 10 + b'\x01')
+
+
+@pytest.mark.parametrize('version', [VERSION, VERSION_2])
+def test_frames_split_byte_by_byte(version):
+    sent, wire = requests(version)
+    decoder = FrameDecoder(version=version)
+    messages = []
+    for i in range(len(wire)):
+        messages += decoder.feed(wire[i: i + 1])
+    assert parse(messages, version) == [request.body for request in sent]
+    assert len(decoder) == 0
+
+
+@pytest.mark.parametrize('version', [VERSION, VERSION_2])
+def test_frames_coalesced_in_one_read(version):
+    sent, wire = requests(version)
+    decoder = FrameDecoder(version=version)
+    assert parse(decoder.feed(wire + wire), version) == [request.body for request in sent] * 2
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7])
+def test_frames_split_at_any_boundary(size):
+    sent, wire = requests(VERSION_2)
+    decoder = FrameDecoder(version=VERSION_2)
+    messages = []
+    for i in range(0, len(wire), size):
+        messages += decoder.feed(wire[i: i + size])
+    assert parse(messages, VERSION_2) == [request.body for request in sent]
+
+
+def test_v1_length_counts_characters():
+    # THTTP/1.1 clients have always counted characters, not utf-8 bytes
+    text = 'send x THTTP/1.1\r\n\r\n你好'
+    frame = (str(len(text)).zfill(3) + text).encode()
+    assert THTTP_Request(method='send', target='x', body='你好').encode() == frame
+    decoder = FrameDecoder()
+    assert decoder.feed(frame[:-1]) == []
+    assert decoder.feed(frame[-1:] + b'000') == [text, '']
+
+
+def test_v1_start_lines_are_shared():
+    first, second = (THTTP_Request(message='send 127.0.0.1 THTTP/1.1\r\n\r\n' + body) for body in ('a', 'b'))
+    assert first.start_line is second.start_line
+    assert first.check() and first.get_method() == 'send'
+    other = THTTP_Request(message='send elsewhere THTTP/1.1\r\n\r\nc')
+    assert other.check() and other.start_line[1] == 'elsewhere'
+
+
+def test_v1_corrupted_length():
+    with pytest.raises(ValueError):
+        FrameDecoder().feed(b'ab1send')
+
+
+def test_preface_split_across_reads():
+    _, wire = requests(VERSION_2)
+    decoder = FrameDecoder(negotiate=True)
+    data = PREFACE + wire
+    messages = []
+    for i in range(len(data)):
+        messages += decoder.feed(data[i: i + 1])
+        if i < len(PREFACE) - 1:
+            assert decoder.version == VERSION
+    assert decoder.version == VERSION_2
+    assert len(messages) == 4
+
+
+def test_no_preface_stays_v1():
+    _, wire = requests(VERSION)
+    decoder = FrameDecoder(negotiate=True)
+    assert len(decoder.feed(wire)) == 4
+    assert decoder.version == VERSION
+
+
+def test_corrupted_preface():
+    with pytest.raises(ValueError):
+        FrameDecoder(negotiate=True).feed(PREFACE[:-1] + b'x')
+
+
+def test_oversized_frame():
+    with pytest.raises(ValueError):
+        FrameDecoder(version=VERSION_2).feed(encode_varint(MAX_FRAME_SIZE + 1))
+
+
+def test_compressed_round_trip():
+    body = 'hello ' * 1000
+    frame = THTTP_Response(status_code='205', body=body).encode(VERSION_2, compress=True)
+    payload = FrameDecoder(version=VERSION_2).feed(frame)[0]
+    assert len(payload) < len(body)
+    response = THTTP_Response(message=payload, version=VERSION_2)
+    assert response.check() and response.body == body
+    assert response.headers == []
+
+
+def test_zlib_bomb():
+    # a small frame that inflates past MAX_FRAME_SIZE
+    request = THTTP_Request(method='send', target='x', headers=[(CONTENT_ENCODING, ZLIB)])
+    payload = request._start_line_v2() + b'\x01' + b''.join(
+        encode_varint(len(field)) + field for field in (CONTENT_ENCODING.encode(), ZLIB.encode()))
+    payload += zlib.compress(b'\0' * (MAX_FRAME_SIZE + 1), 9)
+    assert len(payload) < MAX_FRAME_SIZE // 100
+    with pytest.raises(ValueError):
+        THTTP_Request(message=payload, version=VERSION_2)
+
+
+def test_truncated_v2_fields():
+    payload = THTTP_Request(method='send', target='127.0.0.1', headers=[('Request-Id', '7')]).encode(VERSION_2)
+    payload = FrameDecoder(version=VERSION_2).feed(payload)[0]
+    with pytest.raises(ValueError):
+        THTTP_Request(message=payload[:5], version=VERSION_2)
@@ -0,0 +1,53 @@
+from config import OUTBOUND_QUEUE_SIZE
+from server import Connection, HeldConnection
+
+
+class Stub(Connection):
+    # queues like the engines, the writer never runs
+    peer = None
+
+    def sendall(self, data, chat=False, bounded=True):
+        self._push(data, chat, bounded)
+
+    def evict(self):
+        self.closed = True
+
+
+def hold(connect):
+    held = HeldConnection(connect)
+    held.take_over(connect)
+    return held
+
+
+def test_disconnect_policy_loses_the_session():
+    connect = Stub(policy='disconnect')
+    for _ in range(OUTBOUND_QUEUE_SIZE + 3):
+        connect.sendall(b'x', True)
+    held = hold(connect)
+    assert len(held.outbound) == OUTBOUND_QUEUE_SIZE
+    assert held.lost()
+
+
+def test_drop_oldest_loses_the_session():
+    connect = Stub(policy='drop-oldest')
+    for _ in range(OUTBOUND_QUEUE_SIZE + 1):
+        connect.sendall(b'x', True)
+    assert hold(connect).lost()
+
+
+def test_frames_after_the_transfer_are_lost():
+    connect = Stub()
+    held = hold(connect)
+    assert not held.lost()
+    connect.sendall(b'late', True)
+    assert held.lost()
+
+
+def test_unwritten_frames_go_first_and_whole():
+    connect = Stub()
+    connect.unsent = [memoryview(b'abc')[1:], b'def']
+    connect.sendall(b'ghi')
+    held = hold(connect)
+    held.sendall(b'jkl')
+    assert [data for data, _ in held.outbound] == [b'abc', b'def', b'ghi', b'jkl']
+    assert not held.lost()
@@ -0,0 +1,150 @@
+import threading
+import pytest
+import server
+from config import OUTBOUND_HIGH_WATER
+from protocol import FrameDecoder, THTTP_Response, VERSION
+from server import ChatRoom, Connection, ElasticThreadPool, MemberUpdates
+
+
+class Stub(Connection):
+    # queues like the engines, the writer never runs
+    peer = None
+
+    def sendall(self, data, chat=False, bounded=True):
+        self._push(data, chat, bounded)
+
+    def evict(self):
+        self.closed = True
+
+
+def received(connect):
+    decoder = FrameDecoder(version=VERSION)
+    messages = decoder.feed(b''.join(data for data, _ in connect.outbound))
+    return [THTTP_Response(message=message, version=VERSION) for message in messages]
+
+
+@pytest.fixture
+def small_queue(monkeypatch):
+    monkeypatch.setattr(server, 'OUTBOUND_QUEUE_SIZE', 3)
+
+
+def test_drop_oldest_drops_chat_before_anything_else(small_queue):
+    connect = Stub(policy='drop-oldest')
+    connect.sendall(b'members')
+    connect.sendall(b'chat 1', True)
+    connect.sendall(b'chat 2', True)
+    connect.sendall(b'chat 3', True)
+    assert [data for data, _ in connect.outbound] == [b'members', b'chat 2', b'chat 3']
+    assert connect.dropped == 1
+    assert not connect.closed
+
+
+def test_drop_oldest_without_chat_drops_the_new_frame(small_queue):
+    connect = Stub(policy='drop-oldest')
+    for data in (b'a', b'b', b'c', b'd'):
+        connect.sendall(data)
+    assert [data for data, _ in connect.outbound] == [b'a', b'b', b'c']
+    assert connect.dropped == 1
+
+
+def test_drop_newest(small_queue):
+    connect = Stub(policy='drop-newest')
+    for data in (b'a', b'b', b'c', b'd'):
+        connect.sendall(data, True)
+    assert [data for data, _ in connect.outbound] == [b'a', b'b', b'c']
+    assert connect.dropped == 1
+    assert not connect.closed
+
+
+def test_disconnect_evicts_the_slow_consumer(small_queue):
+    connect = Stub(policy='disconnect')
+    for data in (b'a', b'b', b'c', b'd'):
+        connect.sendall(data, True)
+    assert connect.closed
+    assert connect.dropped == 1
+    connect.sendall(b'e', True)
+    assert connect.dropped == 2
+
+
+def test_byte_high_water_and_oversized_frames():
+    connect = Stub(policy='drop-oldest')
+    half = b'x' * (OUTBOUND_HIGH_WATER // 2)
+    connect.sendall(half, True)
+    connect.sendall(half, True)
+    connect.sendall(b'y', True)
+    assert [data for data, _ in connect.outbound] == [half, b'y']
+    # too large even for an empty queue, the queued frames stay
+    connect.sendall(b'z' * (OUTBOUND_HIGH_WATER + 1))
+    assert [data for data, _ in connect.outbound] == [half, b'y']
+    assert connect.dropped == 2
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    chat = ChatRoom()
+    monkeypatch.setattr(server, 'chat', chat)
+    return chat
+
+
+def member(chat, username, group, deltas):
+    connect = Stub()
+    connect.deltas = deltas
+    chat.connect(connect)
+    chat.sign_in(connect, username)
+    chat.join(connect, group)
+    return connect
+
+
+def test_member_updates_flush(chat):
+    updates = MemberUpdates()
+    old = member(chat, 'old', 'g', deltas=False)
+    new = member(chat, 'new', 'g', deltas=True)
+    updates.changed('g')
+    updates.flush()
+    old.outbound.clear()
+    new.outbound.clear()
+    # changes of one interval coalesce, only the latest change of each user counts
+    joiner = member(chat, 'joiner', 'g', deltas=True)
+    leaver = member(chat, 'leaver', 'g', deltas=False)
+    chat.leave(leaver)
+    updates.changed('g')
+    updates.changed('g')
+    updates.flush()
+    full, = received(old)
+    assert full.get_status_code() == '204'
+    assert sorted(full.body.split(',')) == ['joiner', 'new', 'old']
+    assert [(response.get_status_code(), response.body) for response in received(new)] == \
+        [('209', 'leaver'), ('208', 'joiner')]
+    assert [response.get_status_code() for response in received(joiner)] == ['209', '208']
+    # nothing changed since
+    updates.changed('g')
+    updates.flush()
+    assert len(received(old)) == 1 and len(received(new)) == 2
+
+
+def test_member_updates_skip_deltas_without_delta_members(chat):
+    updates = MemberUpdates()
+    old = member(chat, 'old', 'g', deltas=False)
+    updates.changed('g')
+    updates.flush()
+    assert [(response.get_status_code(), response.body) for response in received(old)] == [('204', 'old')]
+
+
+def test_elastic_pool_refuses_past_the_queue():
+    pool = ElasticThreadPool(0, 1, idle_timeout=0.1, queue_size=1)
+    release = threading.Event()
+    done = threading.Semaphore(0)
+
+    def job():
+        release.wait()
+        done.release()
+
+    assert pool.submit(job) is True
+    assert pool.submit(job) is True
+    # the one thread is taken and the queue is full
+    assert pool.submit(job) is False
+    assert pool.refused == 1
+    release.set()
+    assert done.acquire(timeout=5) and done.acquire(timeout=5)
+    assert pool.submit(job) is True
+    assert done.acquire(timeout=5)
@@ -0,0 +1,60 @@
+import random
+from timerwheel import TimerWheel
+
+
+def run(wheel, until, step):
+    # (firing time, item) of everything that expired, advancing step by step
+    fired = []
+    now = wheel.now * wheel.tick
+    while now < until:
+        now += step
+        fired.extend((now, item) for item in wheel.advance(now))
+    return fired
+
+
+def test_fires_in_deadline_order_never_early():
+    wheel = TimerWheel(0, tick=1.0, slots=8, levels=3)
+    deadlines = [1, 2, 7, 8, 9, 63, 64, 65, 100, 300, 511]
+    for deadline in reversed(deadlines):
+        wheel.schedule(deadline, deadline)
+    assert len(wheel) == len(deadlines)
+    fired = run(wheel, 600, 1)
+    assert [item for _, item in fired] == deadlines
+    for now, deadline in fired:
+        assert deadline <= now < deadline + 1
+    assert len(wheel) == 0
+
+
+def test_random_deadlines_across_levels():
+    rng = random.Random(7)
+    wheel = TimerWheel(5.0, tick=0.5, slots=16, levels=3)
+    deadlines = [5.0 + rng.uniform(0, 1000) for _ in range(500)]
+    for i, deadline in enumerate(deadlines):
+        wheel.schedule(deadline, i)
+    fired = run(wheel, 1010, 0.5)
+    assert sorted(item for _, item in fired) == list(range(500))
+    for now, i in fired:
+        assert deadlines[i] <= now < deadlines[i] + 0.5 + 1e-9
+    assert [now for now, _ in fired] == sorted(now for now, _ in fired)
+
+
+def test_big_jump_fires_everything_due():
+    wheel = TimerWheel(0, tick=1.0, slots=4, levels=3)
+    for deadline in (3, 10, 40, 50):
+        wheel.schedule(deadline, deadline)
+    assert sorted(wheel.advance(45)) == [3, 10, 40]
+    assert wheel.advance(50) == [50]
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(100, tick=1.0)
+    wheel.schedule(50, 'late')
+    assert wheel.advance(100) == []
+    assert wheel.advance(101) == ['late']
+
+
+def test_far_deadline_is_clamped_to_span():
+    wheel = TimerWheel(0, tick=1.0, slots=4, levels=2)
+    wheel.schedule(1000, 'far')
+    fired = run(wheel, 20, 1)
+    assert fired == [(wheel.span, 'far')]
@@ -0,0 +1,56 @@
+import math
+
+
+class TimerWheel:
+    # hierarchical timing wheel: level n has `slots` buckets of slots ** n ticks each.
+    # schedule is O(1) and advancing one tick touches one bucket per level that rolls
+    # over, so many deadlines cost O(1) per tick besides the timers that fire
+    def __init__(self, start, tick=1.0, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.now = int(start / tick)
+        # deadlines further away are clamped, they fire early and the owner reschedules
+        self.span = slots ** levels - 1
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def schedule(self, deadline, item):
+        # deadline in the same clock as start, in seconds
+        t = min(max(int(math.ceil(deadline / self.tick)), self.now + 1), self.now + self.span)
+        self._insert(t, item)
+        self.size += 1
+
+    def _insert(self, t, item):
+        delta = t - self.now
+        width = 1
+        for wheel in self.wheels:
+            if delta < width * self.slots:
+                wheel[(t // width) % self.slots].append((t, item))
+                return
+            width *= self.slots
+
+    def advance(self, now):
+        # move to time now and return the items whose deadline has passed
+        target = int(now / self.tick)
+        expired = []
+        while self.now < target:
+            self.now += 1
+            # cascade the higher levels whose bucket just came round
+            width = self.slots
+            for level in range(1, len(self.wheels)):
+                if self.now % width != 0:
+                    break
+                bucket = self.wheels[level][(self.now // width) % self.slots]
+                self.wheels[level][(self.now // width) % self.slots] = []
+                for t, item in bucket:
+                    self._insert(t, item)
+                width *= self.slots
+            bucket = self.wheels[0][self.now % self.slots]
+            if len(bucket) > 0:
+                self.wheels[0][self.now % self.slots] = []
+                expired.extend(item for _, item in bucket)
+        self.size -= len(expired)
+        return expired